@@ -0,0 +1,272 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Benchmarks for djvubind, run against synthetic pages and stand-in programs (see
+stubtool.py), so that neither real scans nor tesseract and djvulibre are needed.
+
+The microbenchmarks time the python code that runs for every page: hocr parsing,
+boxfile reconciliation, translation to djvused format, and building and running
+commands.  The end-to-end benchmarks time Encoder.enc_book() and whole runs of
+bin/djvubind, in which the stand-in programs take BENCH_LATENCY seconds per call.
+
+Each benchmark reports its throughput (pages per second, or calls per second), the
+median time of a run, and, from one more run under tracemalloc, its peak memory and
+how many memory blocks it left allocated.  Runs of bin/djvubind also report their
+peak RSS: the largest of djvubind and the programs it started.
+"""
+
+import gc
+import json
+import optparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+import djvubind.encode
+import djvubind.ocr
+import djvubind.organizer
+import djvubind.toolchain
+import djvubind.utils
+
+import stubtool
+import synthetic
+
+
+# Options for Encoder, as bin/djvubind would set them with the default config file,
+# except for the number of cores, which is set with --cores so that the benchmarks do
+# the same work on every machine.
+ENCODER_OPTIONS = {'ocr':True,
+                   'bitonal_encoder':'cjb2',
+                   'color_encoder':'csepdjvu',
+                   'lowcolor_encoder':'',
+                   'c44_options':'',
+                   'cjb2_options':'-lossless',
+                   'cpaldjvu_options':'',
+                   'csepdjvu_options':'',
+                   'minidjvu_options':'--lossy -pages-per-dict 100',
+                   'cache':False,
+                   'cache_dir':'',
+                   'cache_size':1024,
+                   'thread_budget':True,
+                   'indirect':False}
+
+# Runs a command and prints the peak RSS (KiB) of it and the programs it started.  The
+# peak of a new process starts from that of the process which forked it, so the
+# command is started from this small, freshly started python rather than from the
+# benchmarks, whose own peak would otherwise be reported.
+RSS_HELPER = ('import resource, subprocess, sys\n'
+              'subprocess.check_call(sys.argv[1:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)\n'
+              'rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss\n'
+              'print(rss // 1024 if sys.platform == "darwin" else rss)\n')
+
+
+def measure(function, units, repeat):
+    """
+    Time function(), which handles the given number of units (pages or calls), repeat
+    times.  Returns the throughput and the median time, along with the peak memory
+    (KiB) and the number of memory blocks left allocated by one more call.
+    """
+
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+    del result
+
+    return {'rate':units / median, 'seconds':median, 'times':times, 'peak_kib':peak // 1024, 'blocks':blocks}
+
+def micro(opts):
+    """
+    Returns the microbenchmarks, as (name, unit, units, function) tuples.
+    """
+
+    pages = opts.pages
+    images = ['/book/page_{0:05d}.tif'.format(number) for number in range(pages)]
+    hocr = [synthetic.hocr([image], opts.density, seed=number) for number, image in enumerate(images)]
+    boxings = [djvubind.ocr.parse_hocr(data, [1650])[0] for data in hocr]
+    boxfiles = [synthetic.boxfile(opts.density, seed=number) for number in range(pages)]
+    files = ['page_{0:05d}.tif'.format(number) for number in range(10000)]
+
+    def parse():
+        out = []
+        for data in hocr:
+            parser = djvubind.ocr.hocrParser()
+            parser.parse(data)
+            out.append(parser.boxing)
+        return out
+
+    def reconcile():
+        return [djvubind.ocr.correct_boxfile(djvubind.ocr.parse_boxfile(boxes), text) for boxes, text in boxfiles]
+
+    def translate():
+        return [djvubind.ocr.translate(boxing) for boxing in boxings]
+
+    # The default limit depends on the size of the environment, so a fixed one is used.
+    def split():
+        return djvubind.utils.split_cmd(['minidjvu', '-d', '300'], files, ['out.djvu'], 32000)
+
+    def run():
+        return [djvubind.utils.run(['true']) for i in range(20)]
+
+    benchmarks = [('hocrParser', 'pages', pages, parse),
+                  ('correct_boxfile', 'pages', pages, reconcile),
+                  ('translate', 'pages', pages, translate),
+                  ('split_cmd', 'files', len(files), split)]
+    if djvubind.toolchain.is_installed('true'):
+        benchmarks.append(('run', 'calls', 20, run))
+
+    return benchmarks
+
+def end_to_end(opts, directory):
+    """
+    Returns the end-to-end benchmarks, as (name, unit, units, function) tuples.  The
+    synthetic book and the stand-in programs are set up in directory.
+    """
+
+    bindir = os.path.join(directory, 'bin')
+    stubtool.install(bindir)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_LATENCY'] = str(opts.latency)
+    os.environ['BENCH_DENSITY'] = str(opts.density)
+
+    bookdir = os.path.join(directory, 'book')
+    paths = synthetic.book(bookdir, opts.pages, opts.color)
+
+    # bin/djvubind reads its options from the config file in the home directory.
+    home = os.path.join(directory, 'home')
+    os.makedirs(os.path.join(home, '.config', 'djvubind'))
+    with open(os.path.join(home, '.config', 'djvubind', 'config'), 'w') as handle:
+        handle.write('ocr = True\ncache = False\ncores = {0}\n'.format(opts.cores))
+
+    def enc_book():
+        book = djvubind.organizer.Book()
+        for path in paths:
+            book.insert_page(path)
+        for page in book.pages:
+            page.is_bitonal()
+            page.get_dpi()
+            page.text = ''
+        book.get_dpi()
+        encoder = djvubind.encode.Encoder(dict(ENCODER_OPTIONS, cores=opts.cores))
+        cwd = os.getcwd()
+        os.chdir(bookdir)
+        try:
+            encoder.enc_book(book, os.path.join(directory, 'enc_book.djvu'))
+        finally:
+            os.chdir(cwd)
+        os.remove(os.path.join(directory, 'enc_book.djvu'))
+
+    def project(*args):
+        def bind():
+            env = dict(os.environ)
+            env['HOME'] = home
+            script = os.path.join(os.path.dirname(here), 'bin', 'djvubind')
+            cmd = [sys.executable, script, '-q', '--no-cache'] + list(args)
+            if resource is None:
+                subprocess.check_call(cmd, cwd=bookdir, env=env, stderr=subprocess.DEVNULL)
+            else:
+                output = subprocess.check_output([sys.executable, '-c', RSS_HELPER] + cmd, cwd=bookdir, env=env)
+                bind.maxrss.append(int(output))
+            os.remove(os.path.join(bookdir, 'book.djvu'))
+        # The peak RSS of each run, in KiB.
+        bind.maxrss = []
+        return bind
+
+    return [('enc_book', 'pages', len(paths), enc_book),
+            ('project', 'pages', len(paths), project()),
+            ('project --pipeline', 'pages', len(paths), project('--pipeline'))]
+
+def run(opts):
+    """
+    Run the selected benchmarks, printing the results as they come, and return them
+    as a dictionary.
+    """
+
+    directory = tempfile.mkdtemp(prefix='djvubind-bench-')
+    results = {}
+    try:
+        benchmarks = micro(opts) + end_to_end(opts, directory)
+        if opts.only is not None:
+            only = opts.only.split(',')
+            benchmarks = [benchmark for benchmark in benchmarks if benchmark[0] in only]
+
+        print('{0:<20} {1:>20} {2:>10} {3:>10} {4:>10} {5:>10}'.format('benchmark', 'rate', 'median (s)', 'peak KiB', 'blocks', 'RSS KiB'))
+        for name, unit, units, function in benchmarks:
+            result = measure(function, units, opts.repeat)
+            result['unit'] = unit
+            maxrss = '-'
+            if getattr(function, 'maxrss', []) != []:
+                result['maxrss_kib'] = max(function.maxrss)
+                maxrss = result['maxrss_kib']
+            results[name] = result
+            rate = '{0:.1f} {1}/s'.format(result['rate'], unit)
+            print('{0:<20} {1:>20} {2:>10.4f} {3:>10} {4:>10} {5:>10}'.format(name, rate, result['seconds'], result['peak_kib'], result['blocks'], maxrss))
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def parser():
+    """
+    Returns a parser for the command line options shared by the benchmark scripts.
+    """
+
+    parser = optparse.OptionParser('usage: %prog [options]')
+    parser.set_defaults(pages=20, density=300, color=0.25, latency=0.0, cores=2, repeat=5, only=None, json=None)
+    parser.add_option('--pages', dest='pages', type='int', help='Number of synthetic pages.  By default, %default.')
+    parser.add_option('--density', dest='density', type='int', help='Words of ocr output per page.  By default, %default.')
+    parser.add_option('--color', dest='color', type='float', help='Fraction of the pages in colour.  By default, %default.')
+    parser.add_option('--latency', dest='latency', type='float', help='Seconds each stand-in program takes per call.  By default, %default.')
+    parser.add_option('--cores', dest='cores', type='int', help='Cores for the encoder and bin/djvubind to use, whatever the machine has.  By default, %default.')
+    parser.add_option('--repeat', dest='repeat', type='int', help='Timed runs of each benchmark.  By default, %default.')
+    parser.add_option('--only', dest='only', help='Comma separated names of the benchmarks to run.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = parser()
+    parser.add_option('--json', dest='json', help='Also write the results to this file.')
+    opts = parser.parse_args()[0]
+    results = run(opts)
+    if opts.json is not None:
+        with open(opts.json, 'w', encoding='utf8') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Checks the benchmarks (see bench.py) against a stored baseline, and exits with status
+1 if any of them got slower or uses more memory.
+
+    python3 benchmarks/regress.py --save    record the baseline (benchmarks/baseline.json)
+    python3 benchmarks/regress.py           compare against it
+
+A comparison uses the settings (pages, density, cores, etc.) the baseline was recorded
+with.  Each benchmark is run several times, and its median time is compared with the
+baseline's.  Memory (tracemalloc's peak, and the peak RSS of bin/djvubind runs) is
+compared as well.
+
+The speed of a machine drifts with load, frequency scaling, its neighbours on shared
+hardware, etc., by far more than a single set of runs shows, and a reference workload
+timed alongside the benchmarks does not drift the same way.  So the baseline is
+recorded as several rounds of the benchmarks, and a benchmark only counts as slower if
+its median is beyond the tolerance of the baseline's median, plus an allowance for the
+noise: the spread of the baseline's rounds, from the fastest to the slowest.  On a
+quiet machine the rounds agree and the check is tight; on a noisy one, record more
+rounds.  Either way, record the baseline on the machine that runs the comparison.
+"""
+
+import json
+import os
+import platform
+import statistics
+import sys
+
+import bench
+
+
+SETTINGS = ['pages', 'density', 'color', 'latency', 'cores', 'repeat']
+
+# The allowance for memory, on top of the relative tolerance, in KiB.
+MEMORY_SLACK = 64
+
+
+def machine():
+    """
+    Returns a description of what the timings depend on.
+    """
+
+    return {'python':platform.python_version(), 'platform':platform.platform(),
+            'processor':platform.machine(), 'cores':os.cpu_count()}
+
+def combine(rounds):
+    """
+    Returns the results of several rounds of the benchmarks as a single set, which keeps
+    the median time of each round.
+    """
+
+    results = {}
+    for name in rounds[0]:
+        runs = [result[name] for result in rounds if name in result]
+        results[name] = {'rate':statistics.median([run['rate'] for run in runs]),
+                         'seconds':statistics.median([run['seconds'] for run in runs]),
+                         'rounds':[run['seconds'] for run in runs],
+                         'times':sum([run['times'] for run in runs], []),
+                         'peak_kib':max([run['peak_kib'] for run in runs]),
+                         'blocks':max([run['blocks'] for run in runs]),
+                         'unit':runs[0]['unit']}
+        maxrss = [run['maxrss_kib'] for run in runs if 'maxrss_kib' in run]
+        if maxrss != []:
+            results[name]['maxrss_kib'] = max(maxrss)
+
+    return results
+
+def compare(baseline, results, tolerance, memory_tolerance):
+    """
+    Compare the results of a run with the baseline.  Returns a list of (benchmark,
+    status, description) tuples, where status is 'ok', 'faster', 'slower', 'memory',
+    'new' or 'missing'.
+    """
+
+    report = []
+    for name in sorted(set(baseline) | set(results)):
+        if name not in results:
+            report.append((name, 'missing', 'not run'))
+            continue
+        if name not in baseline:
+            report.append((name, 'new', '{0:.4f}s'.format(results[name]['seconds'])))
+            continue
+        old = baseline[name]
+        new = results[name]
+        rounds = old.get('rounds', [old['seconds']])
+
+        slack = max(rounds) - min(rounds)
+        change = (new['seconds'] - old['seconds']) / old['seconds']
+        description = '{0:.4f}s -> {1:.4f}s ({2:+.1%}, noise {3:.4f}s)'.format(old['seconds'], new['seconds'], change, slack)
+        if new['seconds'] > old['seconds'] * (1 + tolerance) + slack:
+            report.append((name, 'slower', description))
+        elif new['peak_kib'] > old['peak_kib'] * (1 + memory_tolerance) + MEMORY_SLACK:
+            report.append((name, 'memory', 'peak {0} -> {1} KiB'.format(old['peak_kib'], new['peak_kib'])))
+        elif ('maxrss_kib' in old) and (new.get('maxrss_kib', 0) > old['maxrss_kib'] * (1 + memory_tolerance) + MEMORY_SLACK):
+            report.append((name, 'memory', 'peak RSS {0} -> {1} KiB'.format(old['maxrss_kib'], new['maxrss_kib'])))
+        elif new['seconds'] < old['seconds'] * (1 - tolerance) - slack:
+            report.append((name, 'faster', description))
+        else:
+            report.append((name, 'ok', description))
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = bench.parser()
+    parser.set_defaults(repeat=7, rounds=3, baseline=os.path.join(bench.here, 'baseline.json'), save=False, tolerance=0.15, memory_tolerance=0.2)
+    parser.add_option('--baseline', dest='baseline', help='The baseline file.  By default, %default.')
+    parser.add_option('--save', action='store_true', dest='save', help='Record the results as the new baseline instead of comparing.')
+    parser.add_option('--rounds', dest='rounds', type='int', help='Rounds of the benchmarks to record the baseline from.  By default, %default.')
+    parser.add_option('--tolerance', dest='tolerance', type='float', help='How much slower a benchmark may get, beyond the noise.  By default, %default.')
+    parser.add_option('--memory-tolerance', dest='memory_tolerance', type='float', help='How much more memory a benchmark may use.  By default, %default.')
+    opts, args = parser.parse_args()
+
+    if opts.save:
+        rounds = []
+        for number in range(max(1, opts.rounds)):
+            print('Round {0} of {1}:'.format(number + 1, max(1, opts.rounds)))
+            rounds.append(bench.run(opts))
+        data = {'settings':dict([(setting, getattr(opts, setting)) for setting in SETTINGS]),
+                'machine':machine(),
+                'results':combine(rounds)}
+        with open(opts.baseline, 'w', encoding='utf8') as handle:
+            json.dump(data, handle, indent=2, sort_keys=True)
+            handle.write('\n')
+        print('Baseline saved to {0}.'.format(opts.baseline))
+        sys.exit(0)
+
+    if not os.path.isfile(opts.baseline):
+        print('err: no baseline at {0}; record one with --save.'.format(opts.baseline), file=sys.stderr)
+        sys.exit(1)
+    with open(opts.baseline, encoding='utf8') as handle:
+        baseline = json.load(handle)
+    for setting in SETTINGS:
+        setattr(opts, setting, baseline['settings'][setting])
+    if baseline['machine'] != machine():
+        print('wrn: the baseline was recorded on a different machine ({0}), so timings may not be comparable.'.format(baseline['machine']), file=sys.stderr)
+
+    results = bench.run(opts)
+    report = compare(baseline['results'], results, opts.tolerance, opts.memory_tolerance)
+
+    print('')
+    for name, status, description in report:
+        print('{0:<20} {1:<8} {2}'.format(name, status, description))
+
+    failed = [name for name, status, description in report if status in ['slower', 'memory']]
+    if failed != []:
+        print('Regressions in: {0}'.format(', '.join(failed)), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Stands in for the external programs djvubind uses (tesseract, the djvulibre tools,
+ImageMagick and minidjvu), so that the benchmarks can run without them.  install()
+links this file into a directory under each program's name, and the name it is run
+under decides what it does.  Each program writes plausible output files, after
+sleeping for:
+
+    BENCH_LATENCY_<PROGRAM> or BENCH_LATENCY    seconds (default 0)
+
+tesseract writes hocr with BENCH_DENSITY words per page (default 300), and reports
+itself as version BENCH_TESSERACT_VERSION (default 4.1.1).
+"""
+
+import os
+import shutil
+import sys
+import time
+
+# Make djvubind and the synthetic page generator importable.
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+PROGRAMS = ['c44', 'cjb2', 'convert', 'cpaldjvu', 'csepdjvu', 'ddjvu', 'djvm', 'djvused',
+            'identify', 'minidjvu', 'tesseract']
+
+
+def install(directory):
+    """
+    Make every stand-in program available in directory, which should then be put at
+    the front of PATH.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in PROGRAMS:
+        path = os.path.join(directory, name)
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(os.path.realpath(__file__), path)
+
+    return None
+
+def _fake_djvu(outfile, infiles):
+    with open(outfile, 'wb') as handle:
+        handle.write(b'AT&TFORM')
+        for filename in infiles:
+            handle.write(os.path.basename(filename).encode('utf8') + b'\n')
+
+    return None
+
+def _ppm(path):
+    """
+    Write a greyscale or colour page (an uncompressed TIFF, as synthetic.py writes them)
+    to stdout as a PGM or PPM file.
+    """
+
+    from djvubind import image
+
+    info = image.read_header(path)
+    if info['colorspace'] == 'Gray':
+        magic, channels = 'P5', 1
+    else:
+        magic, channels = 'P6', 3
+    with open(path, 'rb') as handle:
+        handle.seek(8)
+        pixels = handle.read(info['width'] * info['height'] * channels)
+    sys.stdout.buffer.write('{0}\n{1} {2}\n255\n'.format(magic, info['width'], info['height']).encode('ascii') + pixels)
+
+    return None
+
+def _tesseract(args):
+    import synthetic
+    from djvubind import image
+
+    if '--version' in args:
+        print('tesseract ' + os.environ.get('BENCH_TESSERACT_VERSION', '4.1.1'))
+        return 0
+
+    source, base = args[0], args[1]
+    if source.endswith('.txt'):
+        with open(source, encoding='utf8') as handle:
+            images = [line.strip() for line in handle if line.strip() != '']
+    else:
+        images = [source]
+    info = image.get_info(images[0])
+    density = int(os.environ.get('BENCH_DENSITY', '300'))
+    with open(base + '.hocr', 'w', encoding='utf8') as handle:
+        handle.write(synthetic.hocr(images, density, info['width'], info['height'], len(base)))
+
+    return 0
+
+def main(name, args):
+    latency = os.environ.get('BENCH_LATENCY_' + name.upper(), os.environ.get('BENCH_LATENCY', '0'))
+    time.sleep(float(latency))
+
+    if name == 'tesseract':
+        return _tesseract(args)
+    elif name == 'identify':
+        from djvubind import image
+        info = image.read_header(args[-1])
+        print('{depth}|{dpi}|{width}|{height}|{colorspace}|{format}'.format(**info))
+    elif name == 'djvm':
+        if args[0] == '-c':
+            _fake_djvu(args[1], args[2:])
+        elif args[0] == '-i':
+            with open(args[1], 'ab') as handle:
+                handle.write(os.path.basename(args[2]).encode('utf8') + b'\n')
+    elif name == 'djvused':
+        pass
+    elif name == 'convert':
+        if args[-1] == 'ppm:-':
+            _ppm(args[0])
+        else:
+            shutil.copy(args[0], args[-1])
+    elif name == 'minidjvu':
+        files = [arg for arg in args[:-1] if os.path.isfile(arg)]
+        _fake_djvu(args[-1], files)
+    elif (name == 'csepdjvu') and (args[-2] == '-'):
+        sys.stdin.buffer.read()
+        _fake_djvu(args[-1], ['stdin'])
+    else:
+        # c44, cjb2, cpaldjvu, csepdjvu and ddjvu all end with the input and output files.
+        _fake_djvu(args[-1], args[-2:-1])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(os.path.basename(sys.argv[0]), sys.argv[1:]))
@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Generates synthetic pages and ocr output for the benchmarks.  Everything is derived
+from a seed, so that runs can be compared with each other.
+"""
+
+import os
+import random
+import struct
+
+
+WORDS = ['the', 'of', 'and', 'to', 'in', 'soldier', 'handbook', 'canister', 'facepiece',
+         'mask', 'air', 'is', 'cleaned', 'leak', 'between', 'often', 'formed', 'Fig.',
+         '15.', 'carelessly', '&', '<', '>', '"quoted"', "it's", 'back\\slash']
+
+# Size of a character box, relative to the line height.
+CHAR_WIDTH = 0.55
+
+
+def _tiff(width, height, dpi, bits, samples, pixels):
+    """
+    Returns an uncompressed, single strip TIFF file.
+    """
+
+    if samples == 1:
+        photometric = 0
+    else:
+        photometric = 2
+    offset = 8
+    # The resolution rationals and the bits per sample of RGB images are stored after
+    # the image data.
+    extra = offset + len(pixels)
+    tags = [(256, 4, 1, width),
+            (257, 4, 1, height),
+            (258, 3, samples, bits if samples == 1 else extra + 16),
+            (259, 3, 1, 1),
+            (262, 3, 1, photometric),
+            (273, 4, 1, offset),
+            (277, 3, 1, samples),
+            (278, 4, 1, height),
+            (279, 4, 1, len(pixels)),
+            (282, 5, 1, extra),
+            (283, 5, 1, extra + 8),
+            (296, 3, 1, 2)]
+    data = b'II*\x00' + struct.pack('<I', extra + 24) + pixels
+    data = data + struct.pack('<IIII', dpi, 1, dpi, 1) + struct.pack('<HHHH', bits, bits, bits, 0)
+    data = data + struct.pack('<H', len(tags))
+    for tag, kind, count, value in tags:
+        if kind == 3 and count == 1:
+            data = data + struct.pack('<HHIHH', tag, kind, count, value, 0)
+        else:
+            data = data + struct.pack('<HHII', tag, kind, count, value)
+    data = data + struct.pack('<I', 0)
+
+    return data
+
+def text_lines(width, height, rng):
+    """
+    Returns the boxes (xmin, ymin, xmax, ymax, from the top left corner) of the lines of
+    text on a page.
+    """
+
+    margin = width // 10
+    line = max(8, height // 60)
+    lines = []
+    top = margin
+    while top + line < height - margin:
+        right = width - margin - rng.randrange(0, max(1, width // 4))
+        lines.append((margin, top, right, top + line))
+        top = top + line * 2
+
+    return lines
+
+def bitonal_page(path, width=1275, height=1650, dpi=150, seed=0):
+    """
+    Write a bitonal TIFF page with bars of "text" on it.
+    """
+
+    rng = random.Random(seed)
+    stride = (width + 7) // 8
+    blank = bytes(stride)
+    rows = [blank] * height
+    for xmin, ymin, xmax, ymax in text_lines(width, height, rng):
+        row = bytearray(stride)
+        position = xmin
+        while position < xmax:
+            word = rng.randrange(3, 12) * int((ymax - ymin) * CHAR_WIDTH)
+            for x in range(position, min(xmax, position + word)):
+                row[x // 8] |= 0x80 >> (x % 8)
+            position = position + word + (ymax - ymin)
+        row = bytes(row)
+        for y in range(ymin, ymax):
+            rows[y] = row
+    with open(path, 'wb') as handle:
+        handle.write(_tiff(width, height, dpi, 1, 1, b''.join(rows)))
+
+    return None
+
+def color_page(path, width=1275, height=1650, dpi=150, seed=0):
+    """
+    Write an RGB TIFF page with a coloured picture on a white background.
+    """
+
+    rng = random.Random(seed)
+    white = b'\xff\xff\xff' * width
+    picture = (width // 4, height // 4, width * 3 // 4, height // 2)
+    colour = bytes([rng.randrange(256), rng.randrange(256), rng.randrange(256)])
+    row = b'\xff\xff\xff' * picture[0] + colour * (picture[2] - picture[0]) + b'\xff\xff\xff' * (width - picture[2])
+    rows = [white] * picture[1] + [row] * (picture[3] - picture[1]) + [white] * (height - picture[3])
+    with open(path, 'wb') as handle:
+        handle.write(_tiff(width, height, dpi, 8, 3, b''.join(rows)))
+
+    return None
+
+def book(directory, pages=20, color=0.25, width=1275, height=1650, dpi=150, seed=0):
+    """
+    Write a book of synthetic pages into directory, a fraction of them in colour, and
+    return their paths.
+    """
+
+    rng = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for number in range(1, pages + 1):
+        if rng.random() < color:
+            path = os.path.join(directory, 'page_{0:05d}_color.tif'.format(number))
+            color_page(path, width, height, dpi, seed + number)
+        else:
+            path = os.path.join(directory, 'page_{0:05d}.tif'.format(number))
+            bitonal_page(path, width, height, dpi, seed + number)
+        paths.append(path)
+
+    return paths
+
+def _escape(word):
+    return word.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def _words(width, height, density, rng):
+    """
+    Returns lines of (word, (xmin, ymin, xmax, ymax)) for a page with about density words.
+    """
+
+    lines = []
+    count = 0
+    for xmin, ymin, xmax, ymax in text_lines(width, height, rng):
+        if count >= density:
+            break
+        words = []
+        position = xmin
+        size = int((ymax - ymin) * CHAR_WIDTH)
+        while (position < xmax) and (count < density):
+            word = rng.choice(WORDS)
+            end = position + size * len(word)
+            words.append((word, (position, ymin, end, ymax)))
+            position = end + size
+            count = count + 1
+        lines.append(words)
+
+    return lines
+
+def hocr(images, density=300, width=1275, height=1650, seed=0):
+    """
+    Returns tesseract (4 and later) hocr output for a list of images, with about density
+    words on each page.
+    """
+
+    rng = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<html><head><title></title>',
+           "<meta name='ocr-system' content='tesseract 4.1.1' />",
+           "<meta name='ocr-capabilities' content='ocr_page ocr_carea ocr_par ocr_line ocrx_word'/>",
+           '</head><body>']
+    for number, path in enumerate(images):
+        out.append("<div class='ocr_page' id='page_{0}' title='image \"{1}\"; bbox 0 0 {2} {3}; ppageno {4}'>".format(number + 1, path, width, height, number))
+        out.append("<div class='ocr_carea'><p class='ocr_par' lang='eng'>")
+        for index, words in enumerate(_words(width, height, density, rng)):
+            box = (words[0][1][0], words[0][1][1], words[-1][1][2], words[0][1][3])
+            out.append("<span class='ocr_line' id='line_{0}_{1}' title=\"bbox {2} {3} {4} {5}; baseline 0 -5; x_size 30\">".format(number + 1, index + 1, *box))
+            for word, box in words:
+                out.append("<span class='ocrx_word' title='bbox {0} {1} {2} {3}; x_wconf 91'>{4}</span> ".format(box[0], box[1], box[2], box[3], _escape(word)))
+            out.append('</span>')
+        out.append('</p></div></div>')
+    out.append('</body></html>')
+
+    return '\n'.join(out)
+
+def boxfile(density=300, width=1275, height=1650, errors=0.02, seed=0):
+    """
+    Returns a tesseract (before 3.0) boxfile and the plain text it should be reconciled
+    with, for a page with about density words.  A fraction of the characters (errors)
+    differ between the two, as they do in real output.
+    """
+
+    rng = random.Random(seed)
+    boxes = []
+    text = []
+    for words in _words(width, height, density, rng):
+        line = []
+        for word, box in words:
+            size = (box[2] - box[0]) // len(word)
+            for index, char in enumerate(word):
+                if char.isspace():
+                    continue
+                xmin = box[0] + size * index
+                # Boxfiles count from the bottom of the page.
+                boxes.append('{0} {1} {2} {3} {4}'.format(char, xmin, height - box[3], xmin + size, height - box[1]))
+            roll = rng.random()
+            if roll < errors:
+                word = word[1:] or word
+            elif roll < errors * 2:
+                word = word + rng.choice(WORDS)[0]
+            line.append(word)
+        text.append(' '.join(line))
+
+    return '\n'.join(boxes) + '\n', '\n'.join(text) + '\n'
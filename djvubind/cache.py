@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Persistent, content addressed storage of results that are expensive to recreate.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+from . import utils
+
+
+def hash_file(path):
+    """
+    Returns the sha1 hex digest of a file's contents.
+    """
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        buffer = handle.read(1048576)
+        while buffer:
+            digest.update(buffer)
+            buffer = handle.read(1048576)
+
+    return digest.hexdigest()
+
+def default_directory():
+    """
+    Returns the default location of the cache, next to the user's config file.
+    """
+
+    if sys.platform.startswith('win'):
+        directory = os.path.expanduser('~\\Application Data\\djvubind\\cache')
+    else:
+        directory = os.path.expanduser('~/.cache/djvubind')
+
+    return os.path.normpath(directory)
+
+
+class Cache:
+    """
+    A directory of files that are looked up by a key made from everything that affects
+    their content.  The total size is kept under a budget by removing the least
+    recently used entries.  Hits and misses are counted and kept on disk, so the
+    effectiveness of the cache can be reported across runs.
+    """
+
+    def __init__(self, directory, budget, extension=''):
+        self.directory = directory
+        self.budget = budget
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key + self.extension)
+
+    def key(self, *parts):
+        """
+        Combine everything that affects an entry (content hashes, program names,
+        options, etc.) into a single key.
+        """
+
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(str(part).encode('utf8'))
+            digest.update(b'\0')
+
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """
+        Returns the path to the entry for key, or None if there is no such entry.  The
+        entry is marked as recently used.
+        """
+
+        entry = self._entry(key)
+        try:
+            os.utime(entry, None)
+        except OSError:
+            with self.lock:
+                self.misses = self.misses + 1
+            return None
+
+        with self.lock:
+            self.hits = self.hits + 1
+
+        return entry
+
+    def fetch(self, key, destination):
+        """
+        Copy the entry for key to destination.  Returns False on a miss.
+        """
+
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+        shutil.copy(entry, destination)
+
+        return True
+
+    def fetch_text(self, key):
+        """
+        Returns the text stored as the entry for key, or None on a miss.
+        """
+
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        with open(entry, 'r', encoding='utf8') as handle:
+            text = handle.read()
+
+        return text
+
+    def invalidate(self, tag):
+        """
+        Remove every entry if the cache was filled under a different tag, such as the
+        version of the program that produced the entries.  The new tag is remembered.
+        """
+
+        filename = os.path.join(self.directory, 'tag')
+        previous = None
+        if os.path.isfile(filename):
+            with open(filename, 'r', encoding='utf8') as handle:
+                previous = handle.read()
+        if previous == str(tag):
+            return None
+
+        with self.lock:
+            for subdir in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, subdir)
+                if os.path.isdir(subdir):
+                    shutil.rmtree(subdir)
+            self.size = None
+        with open(filename, 'w', encoding='utf8') as handle:
+            handle.write(str(tag))
+
+        return None
+
+    def store(self, key, source):
+        """
+        Copy source into the cache as the entry for key.
+        """
+
+        entry = self._entry(key)
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # Copy under a temporary name first so that an interrupted copy is never
+        # mistaken for a complete entry.
+        temp = '{0}.{1}.{2}.part'.format(entry, os.getpid(), threading.get_ident())
+        shutil.copy(source, temp)
+        os.replace(temp, entry)
+
+        # Only walk the cache directory when the budget might have been exceeded.
+        with self.lock:
+            if self.size is not None:
+                self.size = self.size + os.path.getsize(entry)
+        if (self.size is None) or (self.size > self.budget):
+            self.evict()
+
+        return None
+
+    def store_text(self, key, text):
+        """
+        Store text as the entry for key.
+        """
+
+        entry = self._entry(key)
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        temp = '{0}.{1}.{2}.part'.format(entry, os.getpid(), threading.get_ident())
+        with open(temp, 'w', encoding='utf8') as handle:
+            handle.write(text)
+        os.replace(temp, entry)
+
+        with self.lock:
+            if self.size is not None:
+                self.size = self.size + os.path.getsize(entry)
+        if (self.size is None) or (self.size > self.budget):
+            self.evict()
+
+        return None
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within its budget.
+        """
+
+        with self.lock:
+            entries = []
+            total = 0
+            for subdir in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, subdir)
+                if not os.path.isdir(subdir):
+                    continue
+                for name in os.listdir(subdir):
+                    if name.endswith('.part'):
+                        continue
+                    path = os.path.join(subdir, name)
+                    try:
+                        info = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((info.st_mtime, info.st_size, path))
+                    total = total + info.st_size
+
+            entries.sort()
+            while (total > self.budget) and (len(entries) > 0):
+                mtime, size, path = entries.pop(0)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total = total - size
+            self.size = total
+
+        return None
+
+    def save_stats(self):
+        """
+        Add the hits and misses of this run to the totals kept in the cache directory.
+        """
+
+        stats = self.get_stats()
+        with self.lock:
+            stats['hits'] = stats['hits'] + self.hits
+            stats['misses'] = stats['misses'] + self.misses
+            self.hits = 0
+            self.misses = 0
+        with open(os.path.join(self.directory, 'stats'), 'w') as handle:
+            handle.write('hits = {0}\nmisses = {1}\n'.format(stats['hits'], stats['misses']))
+
+        return None
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the number of hits, misses, entries and the size in
+        bytes of the cache.
+        """
+
+        stats = {'hits':0, 'misses':0, 'entries':0, 'size':0}
+        filename = os.path.join(self.directory, 'stats')
+        if os.path.isfile(filename):
+            saved = utils.parse_config(filename)
+            stats['hits'] = int(saved.get('hits', 0))
+            stats['misses'] = int(saved.get('misses', 0))
+
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if os.path.isdir(subdir):
+                for name in os.listdir(subdir):
+                    if not name.endswith('.part'):
+                        stats['entries'] = stats['entries'] + 1
+                        stats['size'] = stats['size'] + os.path.getsize(os.path.join(subdir, name))
+
+        return stats
+
+    def report(self):
+        """
+        Returns a short, human readable summary of the cache statistics.
+        """
+
+        stats = self.get_stats()
+        lookups = stats['hits'] + stats['misses']
+        if lookups > 0:
+            rate = stats['hits'] / lookups * 100
+        else:
+            rate = 0
+        text = '{0}\n  {1} entries, {2:.1f} MiB of {3:.1f} MiB\n  {4} hits, {5} misses ({6:.1f}% hit rate)'
+        text = text.format(self.directory, stats['entries'], stats['size'] / 1048576, self.budget / 1048576,
+                           stats['hits'], stats['misses'], rate)
+
+        return text
@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Reads and writes the structure of multipage djvu documents: the IFF chunks that djvu
+files are made of, and the directory (DIRM chunk) that lists the components of a
+document.  This is what it takes to write a book as an indirect document, an index
+file next to a file for each page, without rewriting the pages themselves.
+
+The part of the directory with the names of the components is compressed with BZZ,
+which is left to djvulibre's bzz program.
+"""
+
+import os
+import struct
+
+from . import scratch
+from . import utils
+
+
+# Types of components, as kept in the lower bits of their flags.
+INCLUDE = 0
+PAGE = 1
+THUMBNAILS = 2
+SHARED_ANNO = 3
+
+# The other bits of the flags, and the version of the directory format.
+HAS_NAME = 0x80
+HAS_TITLE = 0x40
+TYPE_MASK = 0x3f
+VERSION = 1
+
+
+class Component:
+    """
+    A file in a multipage document: a page, or a file included by pages (a shared
+    dictionary, for example).  offset is where the file starts in a bundled document.
+    """
+
+    def __init__(self, id, kind=PAGE, size=0, offset=0, title=None):
+        self.id = id
+        self.kind = kind
+        self.size = size
+        self.offset = offset
+        self.title = title
+
+
+def chunks(data, start=0, end=None):
+    """
+    Returns the IFF chunks in data between start and end, as (id, start, size) tuples,
+    where start is where the contents of the chunk begin.
+    """
+
+    if end is None:
+        end = len(data)
+
+    found = []
+    position = start
+    while position + 8 <= end:
+        name = data[position:position+4].decode('latin-1')
+        size = struct.unpack('>I', data[position+4:position+8])[0]
+        found.append((name, position + 8, size))
+        # Chunks are padded to an even length.
+        position = position + 8 + size + (size % 2)
+
+    return found
+
+def chunk(name, contents):
+    """
+    Returns an IFF chunk with the given id and contents.
+    """
+
+    data = name.encode('latin-1') + struct.pack('>I', len(contents)) + contents
+    if len(contents) % 2 == 1:
+        data = data + b'\x00'
+
+    return data
+
+def form(data):
+    """
+    Returns the kind of a djvu file ('DJVU' for a page, 'DJVM' for a multipage document,
+    'DJVI' for an included file) and its chunks, given its contents.
+    """
+
+    if (data[:8] != b'AT&TFORM') or (len(data) < 16):
+        raise ValueError('This is not a djvu file.')
+    size = struct.unpack('>I', data[8:12])[0]
+
+    return data[12:16].decode('latin-1'), chunks(data, 16, 12 + size)
+
+def pack_directory(components, bundled=False):
+    """
+    Returns the directory of a list of Components, as the part that is stored as it is
+    and the part that is to be compressed with BZZ.
+    """
+
+    head = struct.pack('>BH', VERSION | (0x80 * bundled), len(components))
+    if bundled:
+        head = head + b''.join([struct.pack('>I', component.offset) for component in components])
+
+    body = b''.join([struct.pack('>I', component.size)[1:] for component in components])
+    strings = b''
+    for component in components:
+        flags = component.kind & TYPE_MASK
+        strings = strings + component.id.encode('utf8') + b'\x00'
+        if component.title is not None:
+            flags = flags | HAS_TITLE
+            strings = strings + component.title.encode('utf8') + b'\x00'
+        body = body + bytes([flags])
+
+    return head, body + strings
+
+def unpack_directory(head, body):
+    """
+    Returns whether a directory is that of a bundled document and its Components, given
+    the part that is stored as it is (and maybe more) and the decompressed part.
+    """
+
+    flags, count = struct.unpack('>BH', head[:3])
+    if flags & 0x7f != VERSION:
+        raise ValueError('Version {0} of the djvu directory format is not supported.'.format(flags & 0x7f))
+    bundled = bool(flags & 0x80)
+
+    components = []
+    for index in range(count):
+        size = struct.unpack('>I', b'\x00' + body[index*3:index*3+3])[0]
+        components.append(Component(None, body[count*3+index] & TYPE_MASK, size))
+        if bundled:
+            components[-1].offset = struct.unpack('>I', head[3+index*4:7+index*4])[0]
+
+    strings = body[count*4:].split(b'\x00')
+    for index in range(count):
+        flags = body[count*3+index]
+        components[index].id = strings.pop(0).decode('utf8')
+        if flags & HAS_NAME:
+            # Components are saved under their id, so names are of no use here.
+            strings.pop(0)
+        if flags & HAS_TITLE:
+            components[index].title = strings.pop(0).decode('utf8')
+
+    return bundled, components
+
+def _bzz(option, data):
+    """
+    Returns data compressed (option '-e') or decompressed (option '-d') by bzz.
+    """
+
+    with scratch.Workspace('bzz') as work:
+        with open(work.path('in'), 'wb') as handle:
+            handle.write(data)
+        utils.run(['bzz', option, work.path('in'), work.path('out')])
+        with open(work.path('out'), 'rb') as handle:
+            data = handle.read()
+
+    return data
+
+def read_directory(data):
+    """
+    Returns the Components of a multipage document, given its contents.
+    """
+
+    kind, found = form(data)
+    if (kind != 'DJVM') or (found[0][0] != 'DIRM'):
+        raise ValueError('This is not a multipage djvu document.')
+    name, start, size = found[0]
+
+    flags, count = struct.unpack('>BH', data[start:start+3])
+    length = 3
+    if flags & 0x80:
+        length = length + count * 4
+
+    return unpack_directory(data[start:start+length], _bzz('-d', data[start+length:start+size]))[1]
+
+def write_index(path, components):
+    """
+    Write the index of an indirect document, whose components are files of their own
+    in the same directory, named by their ids.
+    """
+
+    head, body = pack_directory(components)
+    data = b'DJVM' + chunk('DIRM', head + _bzz('-e', body))
+    with open(path, 'wb') as handle:
+        handle.write(b'AT&T' + chunk('FORM', data))
+
+    return None
+
+def includes(path):
+    """
+    Returns the ids of the files that a page (a djvu file of its own) includes, such as
+    the shared dictionaries of pages split from a minidjvu document.
+    """
+
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    kind, found = form(data)
+
+    return [data[start:start+size].decode('utf8') for name, start, size in found if name == 'INCL']
+
+def split(path, directory, prefix=''):
+    """
+    Write each component of a bundled document into a file of its own in directory,
+    with prefix added to their ids (and to the references of pages to the files they
+    include), and return the Components.
+    """
+
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    components = read_directory(data)
+    ids = dict([(component.id, prefix + component.id) for component in components])
+
+    for component in components:
+        start = component.offset
+        if data[start:start+4] != b'FORM':
+            raise ValueError('Component "{0}" of {1} is not where the directory says.'.format(component.id, path))
+        size = struct.unpack('>I', data[start+4:start+8])[0]
+
+        # Only INCL chunks, which hold the id of an included file, need to be changed.
+        contents = data[start+8:start+12]
+        for name, begin, length in chunks(data, start + 12, start + 8 + size):
+            if name == 'INCL':
+                included = data[begin:begin+length].decode('utf8')
+                contents = contents + chunk(name, ids.get(included, included).encode('utf8'))
+            else:
+                contents = contents + chunk(name, data[begin:begin+length])
+        contents = b'AT&T' + chunk('FORM', contents)
+
+        component.id = ids[component.id]
+        component.size = len(contents)
+        component.offset = 0
+        with open(os.path.join(directory, component.id), 'wb') as handle:
+            handle.write(contents)
+
+    return components
@@ -18,14 +18,51 @@
 Contains code relevant to encoding images and metadata into a djvu format.
 """
 
-import glob
+import concurrent.futures
+import hashlib
 import os
+import queue
+import shlex
 import shutil
 import sys
-
+import threading
+
+from . import cache
+from . import djvm
+from . import image
+from . import scratch
+from . import toolchain
+from . import trace
 from . import utils
 
 
+class ThreadEncode(threading.Thread):
+    """
+    Encodes pages taken from a queue into standalone, single page djvu files.
+    """
+
+    def __init__(self, q, encoder):
+        threading.Thread.__init__(self)
+        self.queue = q
+        self.encoder = encoder
+
+        self.quit = False
+
+    def run(self):
+        while not self.quit:
+            page, outfile = self.queue.get()
+            try:
+                with trace.span('encode', page=page.path):
+                    self.encoder.enc_page(page, outfile)
+                self.encoder.progress()
+            except (Exception, SystemExit):
+                # utils.run() calls sys.exit() on failure, which would only end this
+                # thread.  Record the page so that enc_book() can stop the whole run.
+                self.encoder.failures.append(page)
+            finally:
+                self.queue.task_done()
+
+
 class Encoder:
     """
     An intelligent djvu super-encoder that can work with numerous djvu encoders.
@@ -33,26 +70,46 @@ class Encoder:
 
     def __init__(self, opts):
         self.opts = opts
+        self.completed = 0
+        self.failures = []
+        self.journal = None
+        # The scratch directory of the encoded pages, when there is no journal to keep them.
+        self.directory = None
+        self.lock = threading.Lock()
+        # How many threads each program that encodes a page may use, or None for no limit.
+        self.threads = None
+
+        self.cache = None
+        if self.opts['cache']:
+            directory = self.opts['cache_dir']
+            if directory == '':
+                directory = cache.default_directory()
+            self.cache = cache.Cache(os.path.join(directory, 'pages'), self.opts['cache_size'] * 1048576, '.djvu')
 
         self.dep_check()
 
     def progress(self):
-      pass
+        """
+        Count a finished page (or minidjvu run), for progress reports.
+        """
+
+        self.completed = self.completed + 1
+        return None
 
     def _c44(self, infile, outfile, dpi):
         """
         Encode files with c44.
         """
 
-        # Make sure that the image is in a format acceptable for c44
-        extension = infile.split('.')[-1]
-        if extension not in ['pgm', 'ppm', 'jpg', 'jpeg']:
-            utils.execute('convert {0} {1}'.format(infile, 'temp.ppm'))
-            infile = 'temp.ppm'
+        with scratch.Workspace('c44') as work:
+            # Make sure that the image is in a format acceptable for c44
+            extension = infile.split('.')[-1]
+            if extension not in ['pgm', 'ppm', 'jpg', 'jpeg']:
+                utils.run(['convert', infile, work.path('temp.ppm')], threads=self.threads)
+                infile = work.path('temp.ppm')
 
-        # Encode
-        cmd = 'c44 -dpi {0} {1} "{2}" "{3}"'.format(dpi, self.opts['c44_options'], infile, outfile)
-        utils.execute(cmd)
+            # Encode
+            utils.run(['c44', '-dpi', dpi] + shlex.split(self.opts['c44_options']) + [infile, outfile], threads=self.threads)
 
         # Check that the outfile has been created.
         if not os.path.isfile(outfile):
@@ -60,10 +117,6 @@ class Encoder:
             print(msg, file=sys.stderr)
             sys.exit(1)
 
-        # Cleanup
-        if (infile == 'temp.ppm') and (os.path.isfile('temp.ppm')):
-            os.remove('temp.ppm')
-
         return None
 
     def _cjb2(self, infile, outfile, dpi):
@@ -71,27 +124,28 @@ class Encoder:
         Encode files with cjb2.
         """
 
-        # Make sure that the image is in a format acceptable for cjb2
-        extension = infile.split('.')[-1].lower()
-        if extension not in ['tif','tiff','pbm','pgm','pnm','rle']:
-            print("msg: {0}".format(infile), file=sys.stderr)
-            print("     This is a bitonal image, but is not in a format accepted by cjb2.", file=sys.stderr)
-            print("     Copying to PBM format to be compatible - this may produce a large temporary file!", file=sys.stderr)
-            utils.execute('convert {0} {1}'.format(infile, 'temp.pbm'))
-            infile = 'temp.pbm'
-
-        cmd = 'cjb2 -dpi {0} {1} "{2}" "{3}"'.format(dpi, self.opts['cjb2_options'], infile, outfile)
-
-        # cjb2 will not process images if dpi is greater than 1200 or less than 25, and will exit.
-        # If -dpi is simply not specified it will process the image.
-        # This limitation apparently has to do with some of their algorithms to despeckle and whatenot.
-        if (dpi <= 25) or (dpi >= 1200):
-            msg = 'wrn: encode.Encoder._cjb2(): cjb2 only accepts specified dpi values from 25 to 1200. Omitting dpi for {0}'.format(infile)
-            msg = utils.color(msg, 'red')
-            print(msg, file=sys.stderr)
-            cmd = cmd.replace('-dpi {0} '.format(dpi), '')
-
-        utils.execute(cmd)
+        with scratch.Workspace('cjb2') as work:
+            # Make sure that the image is in a format acceptable for cjb2
+            extension = infile.split('.')[-1].lower()
+            if extension not in ['tif','tiff','pbm','pgm','pnm','rle']:
+                print("msg: {0}".format(infile), file=sys.stderr)
+                print("     This is a bitonal image, but is not in a format accepted by cjb2.", file=sys.stderr)
+                print("     Copying to PBM format to be compatible - this may produce a large temporary file!", file=sys.stderr)
+                utils.run(['convert', infile, work.path('temp.pbm')], threads=self.threads)
+                infile = work.path('temp.pbm')
+
+            cmd = ['cjb2', '-dpi', dpi] + shlex.split(self.opts['cjb2_options']) + [infile, outfile]
+
+            # cjb2 will not process images if dpi is greater than 1200 or less than 25, and will exit.
+            # If -dpi is simply not specified it will process the image.
+            # This limitation apparently has to do with some of their algorithms to despeckle and whatenot.
+            if (dpi <= 25) or (dpi >= 1200):
+                msg = 'wrn: encode.Encoder._cjb2(): cjb2 only accepts specified dpi values from 25 to 1200. Omitting dpi for {0}'.format(infile)
+                msg = utils.color(msg, 'red')
+                print(msg, file=sys.stderr)
+                cmd = cmd[:1] + cmd[3:]
+
+            utils.run(cmd, threads=self.threads)
 
         # Check that the outfile has been created.
         if not os.path.isfile(outfile):
@@ -99,10 +153,6 @@ class Encoder:
             print(msg, file=sys.stderr)
             sys.exit(1)
 
-        # Cleanup
-        if (infile == 'temp.pbm') and (os.path.isfile('temp.pbm')):
-            os.remove('temp.pbm')
-
         return None
 
     def _cpaldjvu(self, infile, outfile, dpi):
@@ -110,15 +160,15 @@ class Encoder:
         Encode files with cpaldjvu.
         """
 
-        # Make sure that the image is in a format acceptable for cpaldjvu
-        extension = infile.split('.')[-1]
-        if extension not in ['ppm']:
-            utils.execute('convert {0} {1}'.format(infile, 'temp.ppm'))
-            infile = 'temp.ppm'
+        with scratch.Workspace('cpaldjvu') as work:
+            # Make sure that the image is in a format acceptable for cpaldjvu
+            extension = infile.split('.')[-1]
+            if extension not in ['ppm']:
+                utils.run(['convert', infile, work.path('temp.ppm')], threads=self.threads)
+                infile = work.path('temp.ppm')
 
-        # Encode
-        cmd = 'cpaldjvu -dpi {0} {1} "{2}" "{3}"'.format(dpi, self.opts['cpaldjvu_options'], infile, outfile)
-        utils.execute(cmd)
+            # Encode
+            utils.run(['cpaldjvu', '-dpi', dpi] + shlex.split(self.opts['cpaldjvu_options']) + [infile, outfile], threads=self.threads)
 
         # Check that the outfile has been created.
         if not os.path.isfile(outfile):
@@ -126,10 +176,6 @@ class Encoder:
             print(msg, file=sys.stderr)
             sys.exit(1)
 
-        # Cleanup
-        if (infile == 'temp.ppm') and (os.path.isfile('temp.ppm')):
-            os.remove('temp.ppm')
-
         return None
 
     def _csepdjvu(self, infile, outfile, dpi):
@@ -137,40 +183,49 @@ class Encoder:
         Encode files with csepdjvu.
         """
 
-        # Separate the bitonal text (scantailor's mixed mode) from everything else.
-        #utils.execute('convert -opaque black "{0}" "temp_graphics.tif"'.format(infile))
-        #utils.execute('convert +opaque black "{0}" "temp_textual.tif"'.format(infile))
-        utils.execute('convert "{0}" -opaque black "temp_graphics.tif"'.format(infile))
-        utils.execute('convert "{0}" +opaque black -monochrome "temp_textual.tif"'.format(infile))
-
-        # Encode the bitonal image.
-        self._cjb2('temp_textual.tif', 'enc_bitonal_out.djvu', dpi)
-
-        # Encode with color with bitonal via csepdjvu
-        utils.execute('ddjvu -format=rle -v "enc_bitonal_out.djvu" "temp_textual.rle"')
-        utils.execute('convert temp_graphics.tif temp_graphics.ppm')
-        with open('temp_merge.mix', 'wb') as mix:
-            with open('temp_textual.rle', 'rb') as rle:
-                buffer = rle.read(1024)
-                while buffer:
-                    mix.write(buffer)
+        with scratch.Workspace('csepdjvu') as work:
+            temp = {'graphics':'graphics.tif', 'textual':'textual.tif', 'bitonal':'bitonal.djvu',
+                    'rle':'textual.rle', 'ppm':'graphics.ppm', 'mix':'merge.mix', 'final':'final.djvu'}
+            for key in temp:
+                temp[key] = work.path(temp[key])
+
+            csepdjvu = ['csepdjvu', '-d', dpi] + shlex.split(self.opts['csepdjvu_options'])
+
+            # Unless cjb2 is told to alter it, the text comes back from cjb2 and ddjvu exactly
+            # as it went in.  Then the page can be separated in memory, with numpy, and piped
+            # straight to csepdjvu, instead of going through five programs and their files.
+            lossy = [option for option in shlex.split(self.opts['cjb2_options']) if option in ['-lossy', '-clean', '-losslevel']]
+            if (image.numpy is not None) and (lossy == []):
+                utils.run(csepdjvu + ['-', temp['final']], input=image.separate(infile, self.threads), threads=self.threads)
+                shutil.move(temp['final'], outfile)
+                return None
+
+            # Separate the bitonal text (scantailor's mixed mode) from everything else.
+            #utils.execute('convert -opaque black "{0}" "temp_graphics.tif"'.format(infile))
+            #utils.execute('convert +opaque black "{0}" "temp_textual.tif"'.format(infile))
+            utils.run(['convert', infile, '-opaque', 'black', temp['graphics']], threads=self.threads)
+            utils.run(['convert', infile, '+opaque', 'black', '-monochrome', temp['textual']], threads=self.threads)
+
+            # Encode the bitonal image.
+            self._cjb2(temp['textual'], temp['bitonal'], dpi)
+
+            # Encode with color with bitonal via csepdjvu
+            utils.run(['ddjvu', '-format=rle', '-v', temp['bitonal'], temp['rle']], threads=self.threads)
+            utils.run(['convert', temp['graphics'], temp['ppm']], threads=self.threads)
+            with open(temp['mix'], 'wb') as mix:
+                with open(temp['rle'], 'rb') as rle:
                     buffer = rle.read(1024)
-            with open('temp_graphics.ppm', 'rb') as ppm:
-                buffer = ppm.read(1024)
-                while buffer:
-                    mix.write(buffer)
+                    while buffer:
+                        mix.write(buffer)
+                        buffer = rle.read(1024)
+                with open(temp['ppm'], 'rb') as ppm:
                     buffer = ppm.read(1024)
-        utils.execute('csepdjvu -d {0} {1} "temp_merge.mix" "temp_final.djvu"'.format(dpi, self.opts['csepdjvu_options']))
+                    while buffer:
+                        mix.write(buffer)
+                        buffer = ppm.read(1024)
+            utils.run(csepdjvu + [temp['mix'], temp['final']], threads=self.threads)
 
-        if (not os.path.isfile(outfile)):
-            shutil.move('temp_final.djvu', outfile)
-        else:
-            utils.execute('djvm -i {0} "temp_final.djvu"'.format(outfile))
-
-        # Clean up
-        for tempfile in glob.glob('temp_*'):
-            os.remove(tempfile)
-        os.remove('enc_bitonal_out.djvu')
+            shutil.move(temp['final'], outfile)
 
         return None
 
@@ -182,9 +237,6 @@ class Encoder:
         better compression with a shared dictionary across multiple images.
         """
 
-        # Specify filenames that will be used.
-        tempfile = 'enc_temp.djvu'
-
         temp_files = []
         for filename in infiles:
             extension = filename.split('.')[-1].lower()
@@ -204,144 +256,482 @@ class Encoder:
             print("     minidjvu will accept PBM, PNM, and TIF files. Convert by hand before proceeding.", file=sys.stderr)
             sys.exit(1)
 
-        # Minidjvu has to worry about the length of the command since all the filenames are
-        # listed.
-        cmds = utils.split_cmd('minidjvu -d {0} {1}'.format(dpi, self.opts['minidjvu_options']), infiles, tempfile)
+        # minidjvu only shares dictionaries between the pages of each group of
+        # pages-per-dict, counted from the first page of a command.  Groups are therefore
+        # independent, and encoding them with separate commands, all at once, costs no
+        # compression.  Groups that are still too long for a command have to be split.
+        options = shlex.split(self.opts['minidjvu_options'])
+        size = self._pages_per_dict(options)
+        if size == 0:
+            size = len(infiles)
+
+        with scratch.Workspace('minidjvu') as work:
+            cmds = []
+            for index in range(0, len(infiles), size):
+                for cmd in utils.split_cmd(['minidjvu', '-d', str(dpi)] + options, infiles[index:index+size], [work.path('part0000.djvu')]):
+                    cmd[-1] = work.path('part{0:04d}.djvu'.format(len(cmds)+1))
+                    cmds.append(cmd)
+
+            threadcount = max(1, min(self.opts['cores'], len(cmds)))
+            with concurrent.futures.ThreadPoolExecutor(threadcount) as executor:
+                list(executor.map(utils.run, cmds))
+
+            # Bundle the results into a single, multipage djvu, in order.
+            self.djvu_bundle([cmd[-1] for cmd in cmds], outfile)
+
+        return None
+
+    def _pages_per_dict(self, options):
+        """
+        Returns how many pages minidjvu is told to put in each shared dictionary, or 0 if
+        the options do not say.
+        """
+
+        for index in range(len(options) - 1):
+            if options[index] in ['-p', '-pages-per-dict', '--pages-per-dict']:
+                try:
+                    return max(0, int(options[index+1]))
+                except ValueError:
+                    return 0
+
+        return 0
+
+    def _encode_cached(self, encoder, infile, outfile, dpi, digest=None):
+        """
+        Encode infile with the named encoder, unless the same image has already been
+        encoded with the same encoder, options and dpi.  In that case the result is
+        copied from the cache instead.  digest is the hash of infile, if already known.
+        """
+
+        functions = {'c44':self._c44, 'cjb2':self._cjb2, 'cpaldjvu':self._cpaldjvu, 'csepdjvu':self._csepdjvu}
+        if self.cache is None:
+            functions[encoder](infile, outfile, dpi)
+            return None
 
-        # Execute each command, adding each result into a single, multipage djvu.
-        for cmd in cmds:
-            utils.execute(cmd)
-            self.djvu_insert(tempfile, outfile)
+        options = self.opts[encoder+'_options']
+        if encoder == 'csepdjvu':
+            # The textual part is encoded with cjb2.
+            options = options + ' ' + self.opts['cjb2_options']
+        if digest is None:
+            digest = cache.hash_file(infile)
+        key = self.cache.key(digest, encoder, options, dpi)
 
-        os.remove(tempfile)
-        for replacement in temp_files:
-            os.remove(replacement)
+        if not self.cache.fetch(key, outfile):
+            functions[encoder](infile, outfile, dpi)
+            self.cache.store(key, outfile)
 
         return None
 
+    def _scratch(self, name):
+        """
+        Returns where an intermediate file should be written.  With a journal, files are
+        kept in its directory so that they can be reused if the run is interrupted.
+        Otherwise they go to a scratch directory that is removed with the book.
+        """
+
+        if self.journal is not None:
+            return self.journal.path(name)
+        with self.lock:
+            if self.directory is None:
+                self.directory = scratch.make('book')
+        return os.path.join(self.directory, name)
+
+    def is_standalone(self, page):
+        """
+        Returns True if the page is encoded on its own into a standalone djvu file, rather
+        than as part of a minidjvu run or not at all (for lack of a valid encoder).
+        """
+
+        if page.bitonal:
+            return (self.opts['bitonal_encoder'] == 'cjb2')
+        else:
+            return (self.color_encoder(page) in ['csepdjvu', 'c44', 'cpaldjvu'])
+
+    def color_encoder(self, page):
+        """
+        Returns the encoder for a page that is not bitonal.  Low colour pages use the
+        lowcolor_encoder option, if it is set.
+        """
+
+        if (page.kind == 'lowcolor') and (self.opts['lowcolor_encoder'] != ''):
+            return self.opts['lowcolor_encoder']
+        return self.opts['color_encoder']
+
+    def _bitonal_file(self, page, work):
+        """
+        Returns a file with the image of a bitonal page, in a format the bitonal encoders
+        accept.  Pages that are stored with more than one bit per pixel are written to
+        a PBM file in work (a scratch.Workspace).
+        """
+
+        if page.info['depth'] == 1:
+            return page.path
+        filename = work.path(os.path.splitext(os.path.basename(page.path))[0] + '.pbm')
+        image.write_pbm(page.path, filename, self.threads)
+
+        return filename
+
+    def _encoded_file(self, kind, page, pages=None):
+        """
+        Returns the name of a file encoded from page (and the rest of pages, for a minidjvu
+        run).  Files are named after the image and its stamp rather than the position of
+        the page, so that pages added before a --resume cannot be written over the files
+        of pages that are reused from the journal.  Names that a journal record gives to
+        other pages are skipped all the same.
+        """
+
+        info = os.stat(page.path)
+        stamp = '{0}|{1}|{2}'.format(os.path.abspath(page.path), info.st_size, info.st_mtime_ns)
+        name = '{0}-{1}'.format(os.path.splitext(os.path.basename(page.path))[0], hashlib.sha1(stamp.encode('utf8')).hexdigest()[:10])
+        if pages is None:
+            pages = [page]
+
+        filename = self._scratch('enc_{0}_{1}.djvu'.format(kind, name))
+        count = 1
+        while (self.journal is not None) and self.journal.claimed(filename, [other.path for other in pages]):
+            count = count + 1
+            filename = self._scratch('enc_{0}_{1}-{2}.djvu'.format(kind, name, count))
+
+        return filename
+
+    def page_file(self, page):
+        """
+        Returns the name of the standalone djvu file for a page.
+        """
+
+        return self._encoded_file('page', page)
+
     def dep_check(self):
         """
         Check for ocr engine availability.
         """
 
-        if not utils.is_executable(self.opts['bitonal_encoder']):
+        if not toolchain.is_installed(self.opts['bitonal_encoder']):
             msg = 'err: encoder "{0}" is not installed.'.format(self.opts['bitonal_encoder'])
             print(msg, file=sys.stderr)
             sys.exit(1)
-        if not utils.is_executable(self.opts['color_encoder']):
+        if not toolchain.is_installed(self.opts['color_encoder']):
             msg = 'err: encoder "{0}" is not installed.'.format(self.opts['color_encoder'])
             print(msg, file=sys.stderr)
             sys.exit(1)
+        if (self.opts['lowcolor_encoder'] != '') and (not toolchain.is_installed(self.opts['lowcolor_encoder'])):
+            msg = 'err: encoder "{0}" is not installed.'.format(self.opts['lowcolor_encoder'])
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+        if self.opts['indirect'] and (not toolchain.is_installed('bzz')):
+            msg = 'err: bzz (part of djvulibre) is needed for indirect output, but is not installed.'
+            print(msg, file=sys.stderr)
+            sys.exit(1)
 
         return None
 
-    def djvu_insert(self, infile, djvufile, page_num=None):
+    def djvu_bundle(self, infiles, outfile):
         """
-        Insert a single page djvu file into a multipage djvu file.  By default it will be
-        placed at the end, unless page_num is specified.
+        Bundle single or multipage djvu files into one multipage djvu file, keeping the
+        order of infiles.  This is done with a single djvm call, unless the command would
+        be too long; then groups of files are bundled first and the groups are merged.
+        Either way, each page is written a small and fixed number of times, unlike
+        repeated insertions with djvm -i which rewrite the whole file for every page.
         """
-        if (not os.path.isfile(djvufile)):
-            shutil.copy(infile, djvufile)
-        elif page_num is None:
-            utils.execute('djvm -i "{0}" "{1}"'.format(djvufile, infile))
+
+        if len(infiles) == 1:
+            shutil.copy(infiles[0], outfile)
+            return None
+
+        # See utils.command_limit() for how long commands may be.
+        cmds = utils.split_cmd(['djvm', '-c', outfile], infiles)
+
+        if len(cmds) == 1:
+            utils.run(cmds[0])
         else:
-            utils.execute('djvm -i "{0}" "{1}" {2}'.format(djvufile, infile, int(page_num)))
+            with scratch.Workspace('bundle') as work:
+                parts = []
+                for cmd in cmds:
+                    part = work.path('group{0:04d}.djvu'.format(len(parts)+1))
+                    self.djvu_bundle(cmd[3:], part)
+                    parts.append(part)
+                self.djvu_bundle(parts, outfile)
 
-    def enc_book(self, book, outfile):
+        return None
+
+    def djvu_index(self, infiles, outfile):
         """
-        Encode pages, metadata, etc. contained within a organizer.Book() class.
+        Write single page djvu files, in the order of infiles, as an indirect document:
+        outfile is an index of the pages, which are each kept in a file of their own next
+        to it.  The pages are linked into place where possible, along with the files they
+        include (the shared dictionaries of minidjvu), so that assembling the book takes
+        time in proportion to the size of the index rather than of the pages.
         """
 
-        tempfile = 'temp.djvu'
+        directory = os.path.dirname(outfile)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        components = []
+        included = set()
+        for infile in infiles:
+            name = os.path.basename(infile)
+            if name.startswith('enc_'):
+                name = name[4:]
+            # Pages refer to the files they include by name, and each is only listed once,
+            # before the first page that needs it.
+            files = [(os.path.join(os.path.dirname(infile), id), id, djvm.INCLUDE) for id in djvm.includes(infile) if id not in included]
+            included.update([id for source, id, kind in files])
+            for source, id, kind in files + [(infile, name, djvm.PAGE)]:
+                target = os.path.join(directory, id)
+                if os.path.lexists(target):
+                    os.remove(target)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy(source, target)
+                components.append(djvm.Component(id, kind, os.path.getsize(target)))
+
+        djvm.write_index(outfile, components)
 
-        # Encode bitonal images first, mainly because of minidjvu needing to do
-        # them all at once.
-        if self.opts['bitonal_encoder'] == 'minidjvu':
-            bitonals = []
-            for page in book.pages:
-                if page.bitonal:
-                    filepath = os.path.split(page.path)[1]
-                    bitonals.append(filepath)
-            if len(bitonals) > 0:
-                if self.opts['bitonal_encoder'] == 'minidjvu':
-                    self._minidjvu(bitonals, tempfile, book.dpi)
-                    self.djvu_insert(tempfile, outfile)
-                    os.remove(tempfile)
-                    self.progress()
-        elif self.opts['bitonal_encoder'] == 'cjb2':
-            for page in book.pages:
-                if page.bitonal:
-                    self._cjb2(page.path, tempfile, page.dpi)
-                    self.djvu_insert(tempfile, outfile)
-                    os.remove(tempfile)
-                    self.progress()
+        return None
+
+    def enc_page(self, page, outfile):
+        """
+        Encode a single organizer.Page() into a standalone djvu file, using the encoder
+        configured for that type of page.
+        """
+
+        digest = None
+        if self.cache is not None:
+            digest = page.get_hash()
+
+        if page.bitonal:
+            if self.opts['bitonal_encoder'] == 'cjb2':
+                with scratch.Workspace('bitonal') as work:
+                    self._encode_cached('cjb2', self._bitonal_file(page, work), outfile, page.dpi, digest)
+            else:
+                raise ValueError('The bitonal encoder ({0}) cannot encode single pages.'.format(self.opts['bitonal_encoder']))
         else:
+            encoder = self.color_encoder(page)
+            if encoder in ['csepdjvu', 'c44', 'cpaldjvu']:
+                self._encode_cached(encoder, page.path, outfile, page.dpi, digest)
+            else:
+                raise ValueError('The color encoder ({0}) is not supported.'.format(encoder))
+
+        # Adding the text layer here, while the file is still a single page, is far
+        # cheaper than rewriting the whole book for every page later on.
+        if self.opts['ocr']:
+            self.set_text(outfile, [page])
+
+        if self.journal is not None:
+            self.journal.record('encode', page, {'file':outfile})
+
+        return None
+
+    def enc_pages(self, jobs):
+        """
+        Encode a list of (page, outfile) pairs with a pool of threads, one standalone
+        djvu file per page.  The number of threads is set by the 'cores' option, and any
+        cores left over when there are fewer pages go to ImageMagick.
+        """
+
+        if len(jobs) == 0:
+            return None
+
+        threadcount = self.opts['cores']
+        if threadcount > len(jobs):
+            threadcount = len(jobs)
+        if threadcount < 1:
+            threadcount = 1
+        if self.opts['thread_budget']:
+            threadcount, self.threads = utils.split_threads(self.opts['cores'], len(jobs))
+
+        q = queue.Queue()
+        for job in jobs:
+            q.put(job)
+
+        for i in range(threadcount):
+            p = ThreadEncode(q, self)
+            p.daemon = True
+            p.start()
+        q.join()
+
+        self.report_failures()
+
+        return None
+
+    def report_failures(self):
+        """
+        Stop the run if any page could not be encoded.
+        """
+
+        if len(self.failures) > 0:
+            for page in self.failures:
+                msg = 'err: encode.Encoder.enc_pages(): Failed to encode "{0}".'.format(page.path)
+                print(utils.color(msg, 'red'), file=sys.stderr)
+            sys.exit(1)
+
+        return None
+
+    def set_text(self, djvufile, pages):
+        """
+        Add the ocr text of the given pages (a list of organizer.Page()) to the hidden
+        text layer of djvufile, the first page going to the first page of the file and so
+        on.  All pages are done in a single djvused session.
+        """
+
+        with scratch.Workspace('text') as work:
+            script = ''
+            for page in pages:
+                if page.text == '':
+                    continue
+                textfile = work.path('ocr{0:04d}.txt'.format(pages.index(page) + 1))
+                with open(textfile, 'w', encoding='utf8') as handle:
+                    handle.write(page.text)
+                script += 'select {0}; remove-txt; set-txt "{1}";\n'.format(pages.index(page) + 1, textfile)
+
+            if script != '':
+                script += 'save'
+                with open(work.path('ocr.djvused'), 'w', encoding='utf8') as handle:
+                    handle.write(script)
+                utils.run(['djvused', '-f', work.path('ocr.djvused'), djvufile], check=False)
+
+        return None
+
+    def enc_book(self, book, outfile, encoded=None):
+        """
+        Encode pages, metadata, etc. contained within a organizer.Book() class.  encoded
+        maps pages that were already encoded into standalone files (e.g. by the pipeline
+        in bin/djvubind) to those files.  With the 'indirect' option, outfile is the
+        index of an indirect document (see djvu_index()).
+        """
+
+        if encoded is None:
+            encoded = {}
+
+        if self.opts['bitonal_encoder'] not in ['cjb2', 'minidjvu']:
             for page in book.pages:
-                if not page.bitonal:
+                if page.bitonal:
                     msg = 'wrn: Invalid bitonal encoder.  Bitonal pages will be omitted.'
                     msg = utils.color(msg, 'red')
                     print(msg, file=sys.stderr)
                     break
-
-        # Encode and insert non-bitonal
-        if self.opts['color_encoder'] == 'csepdjvu':
-            for page in book.pages:
-                if not page.bitonal:
-                    page_number = book.pages.index(page) + 1
-                    self._csepdjvu(page.path, tempfile, page.dpi)
-                    self.djvu_insert(tempfile, outfile, page_number)
-                    os.remove(tempfile)
-                    self.progress()
-        elif self.opts['color_encoder'] == 'c44':
-            for page in book.pages:
-                if not page.bitonal:
-                    page_number = book.pages.index(page) + 1
-                    self._c44(page.path, tempfile, page.dpi)
-                    self.djvu_insert(tempfile, outfile, page_number)
-                    os.remove(tempfile)
-                    self.progress()
-        elif self.opts['color_encoder'] == 'cpaldjvu':
-            for page in book.pages:
-                if not page.bitonal:
-                    page_number = book.pages.index(page) + 1
-                    self._cpaldjvu(page.path, tempfile, page.dpi)
-                    self.djvu_insert(tempfile, outfile, page_number)
-                    os.remove(tempfile)
-                    self.progress()
-        else:
+        if self.opts['color_encoder'] not in ['csepdjvu', 'c44', 'cpaldjvu']:
             for page in book.pages:
-                if not page.bitonal:
+                if (not page.bitonal) and (self.color_encoder(page) == self.opts['color_encoder']):
                     msg = 'wrn: Invalid color encoder.  Colored pages will be omitted.'
                     msg = utils.color(msg, 'red')
                     print(msg, file=sys.stderr)
                     break
 
-        # Add ocr data
-        if self.opts['ocr']:
-            for page in book.pages:
-                handle = open('ocr.txt', 'w', encoding="utf8")
-                handle.write(page.text)
-                handle.close()
-                page_number = book.pages.index(page) + 1
-                utils.simple_exec('djvused -e "select {0}; remove-txt; set-txt \'ocr.txt\'; save" "{1}"'.format(page_number, outfile))
-                os.remove('ocr.txt')
-
-        # Insert front/back covers, metadata, and bookmarks
+        # Sort the pages into the files that will be bundled, in page order.  minidjvu
+        # encodes all of the bitonal pages together, in chunks that share a dictionary,
+        # and its document is then split into a file for each page (plus the dictionaries
+        # they include), which take their place among the other pages.  Every other page
+        # is encoded on its own into a standalone djvu file, which can be done
+        # concurrently.
+        components = []
+        jobs = []
+        bitonals = []
+        for page in book.pages:
+            if page.bitonal and (self.opts['bitonal_encoder'] == 'minidjvu'):
+                # The page stands in for its file until the pages are split.
+                bitonals.append(page)
+                components.append(page)
+            elif not self.is_standalone(page):
+                continue
+            elif page in encoded:
+                components.append(encoded[page])
+            else:
+                filename = self.page_file(page)
+                if self.journal is not None:
+                    # Reuse the page if it was already encoded by an interrupted run.
+                    done = self.journal.lookup('encode', page)
+                    if done is not None:
+                        filename = done['file']
+                        components.append(filename)
+                        continue
+                jobs.append((page, filename))
+                components.append(filename)
+
+        if len(bitonals) > 0:
+            filename = self._encoded_file('run', bitonals[0], bitonals)
+            done = None
+            if self.journal is not None:
+                done = [self.journal.lookup('encode', page) for page in bitonals]
+            if (done is None) or (done.count({'file':filename}) != len(bitonals)):
+                with trace.span('encode run', page=bitonals[0].path, pages=len(bitonals)):
+                    with scratch.Workspace('bitonal') as work:
+                        infiles = []
+                        for page in bitonals:
+                            if page.info['depth'] == 1:
+                                infiles.append(os.path.split(page.path)[1])
+                            else:
+                                infiles.append(self._bitonal_file(page, work))
+                        if self.cache is None:
+                            self._minidjvu(infiles, filename, book.dpi)
+                        else:
+                            # The pages share their dictionaries, so they are cached as a whole.
+                            key = self.cache.key(*([page.get_hash() for page in bitonals] + ['minidjvu', self.opts['minidjvu_options'], book.dpi]))
+                            if not self.cache.fetch(key, filename):
+                                self._minidjvu(infiles, filename, book.dpi)
+                                self.cache.store(key, filename)
+                    if self.opts['ocr']:
+                        self.set_text(filename, bitonals)
+                if self.journal is not None:
+                    for page in bitonals:
+                        self.journal.record('encode', page, {'file':filename})
+                self.progress()
+
+            # The files are named after the document, which keeps them apart from those
+            # of other documents, and from the 'enc_' prefix that djvu_index() drops.  A
+            # single page is not a multipage document, and is used as it is.
+            with open(filename, 'rb') as handle:
+                kind = handle.read(16)[12:16]
+            if kind == b'DJVM':
+                name = os.path.splitext(os.path.basename(filename))[0]
+                pages = [component.id for component in djvm.split(filename, os.path.dirname(filename), name[4:] + '_') if component.kind == djvm.PAGE]
+            else:
+                pages = [os.path.basename(filename)]
+            if len(pages) != len(bitonals):
+                msg = 'err: encode.Encoder.enc_book(): minidjvu encoded {0} bitonal pages into {1} pages.'.format(len(bitonals), len(pages))
+                print(msg, file=sys.stderr)
+                sys.exit(1)
+            pages = dict(zip(bitonals, [os.path.join(os.path.dirname(filename), id) for id in pages]))
+            components = [pages.get(component, component) for component in components]
+        self.enc_pages(jobs)
+
+        # Encode the front/back covers
         if book.suppliments['cover_front'] is not None:
-            dpi = int(utils.execute('identify -ping -format %x "{0}"'.format(book.suppliments['cover_front']), capture=True).decode('ascii').split(' ')[0])
-            self._c44(book.suppliments['cover_front'], tempfile, dpi)
-            self.djvu_insert(tempfile, outfile, 1)
-            utils.execute('djvused -e "select 1; set-page-title cover; save" "{0}"'.format(outfile))
+            with trace.span('encode', page=book.suppliments['cover_front']):
+                dpi = image.get_info(book.suppliments['cover_front'])['dpi']
+                self._encode_cached('c44', book.suppliments['cover_front'], self._scratch('enc_cover_front.djvu'), dpi)
+            components.insert(0, self._scratch('enc_cover_front.djvu'))
         if book.suppliments['cover_back'] is not None:
-            dpi = int(utils.execute('identify -ping -format %x "{0}"'.format(book.suppliments['cover_back']), capture=True).decode('ascii').split(' ')[0])
-            self._c44(book.suppliments['cover_back'], tempfile, dpi)
-            self.djvu_insert(tempfile, outfile, -1)
+            with trace.span('encode', page=book.suppliments['cover_back']):
+                dpi = image.get_info(book.suppliments['cover_back'])['dpi']
+                self._encode_cached('c44', book.suppliments['cover_back'], self._scratch('enc_cover_back.djvu'), dpi)
+            components.append(self._scratch('enc_cover_back.djvu'))
+        if self.cache is not None:
+            self.cache.save_stats()
+
+        # Assemble everything in a single pass, regardless of the order in which the
+        # pages were finished.
+        if (len(components) > 0) and self.opts['indirect']:
+            with trace.span('index', pages=len(components)):
+                self.djvu_index(components, outfile)
+        elif len(components) > 0:
+            with trace.span('bundle', pages=len(components)):
+                self.djvu_bundle(components, outfile)
+        # The journal removes its files once the book is finished.
+        if self.directory is not None:
+            scratch.remove(self.directory)
+            self.directory = None
+
+        # Everything else that applies to the whole book is done in one djvused
+        # session, so that the book is only written once more.  Titles and the outline
+        # of an indirect document are kept in its index, so only the index is written.
+        script = ''
         if book.suppliments['metadata'] is not None:
-            utils.simple_exec('djvused -e "set-meta {0}; save" "{1}"'.format(book.suppliments['metadata'], outfile))
+            script += 'set-meta "{0}";\n'.format(book.suppliments['metadata'])
         if book.suppliments['bookmarks'] is not None:
-            utils.simple_exec('djvused -e "set-outline {0}; save" "{1}"'.format(book.suppliments['bookmarks'], outfile))
-
-        script = ''
+            script += 'set-outline "{0}";\n'.format(book.suppliments['bookmarks'])
         index = 1
         if book.suppliments['cover_front'] is not None:
             script += 'select '+str(index)+'; set-page-title "cover";\n'
@@ -354,13 +744,12 @@ class Encoder:
                 index = index + 1
         if book.suppliments['cover_back'] is not None:
             script += 'select '+str(index)+'; set-page-title "back cover";\n'
-        script += 'save'
-        with open('titles', 'w') as handle:
-            handle.write(script)
-        utils.simple_exec('djvused -f titles "{0}"'.format(outfile))
-        os.remove('titles')
-
-        if os.path.isfile(tempfile):
-            os.remove(tempfile)
+        if script != '':
+            script += 'save'
+            with scratch.Workspace('book') as work:
+                with open(work.path('book.djvused'), 'w', encoding='utf8') as handle:
+                    handle.write(script)
+                with trace.span('book info'):
+                    utils.run(['djvused', '-f', work.path('book.djvused'), outfile], check=False)
 
         return None
@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Reads image properties straight from the file headers of the formats djvubind accepts,
+and, when numpy is installed, classifies pages by their pixels and separates the pages
+given to csepdjvu.
+"""
+
+import io
+import struct
+
+from . import utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Resolution assumed by ImageMagick when a file does not record one.
+DEFAULT_DPI = 72
+
+# Size in bytes of each TIFF field type that can hold a value djvubind needs.
+TIFF_TYPES = {1:('B', 1), 3:('H', 2), 4:('I', 4), 5:('II', 8)}
+
+TIFF_PHOTOMETRIC = {0:'Gray', 1:'Gray', 2:'sRGB', 3:'sRGB', 5:'CMYK', 6:'YCbCr', 8:'Lab'}
+
+PNM_FORMATS = {b'P1':'PBM', b'P4':'PBM', b'P2':'PGM', b'P5':'PGM', b'P3':'PPM', b'P6':'PPM'}
+
+# The maximum values of PNM files whose samples are exactly of a depth.
+PNM_DEPTHS = {1:1, 255:8, 65535:16}
+
+# The most colours a page can have and still count as low colour, which is as many as
+# cpaldjvu uses by default.
+LOWCOLOR_MAX = 256
+
+# The longest run that can be written in djvulibre's RLE format, and the shortest one
+# that takes two bytes.
+RLE_MAX = 0x3fff
+RLE_LONG = 0xc0
+
+
+def _read_tiff(handle):
+    """
+    Returns the properties of the first image in a TIFF file, or None if the header
+    cannot be decoded.  Only the header and the first image file directory are read.
+    """
+
+    header = handle.read(8)
+    if header[:4] == b'II*\x00':
+        order = '<'
+    elif header[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        # BigTIFF and anything else are left to ImageMagick.
+        return None
+
+    offset = struct.unpack(order + 'I', header[4:8])[0]
+    handle.seek(offset)
+    count = struct.unpack(order + 'H', handle.read(2))[0]
+    entries = handle.read(12 * count)
+    if len(entries) != 12 * count:
+        return None
+
+    tags = {}
+    for i in range(count):
+        tag, kind, number, value = struct.unpack(order + 'HHI4s', entries[12*i:12*i+12])
+        if (tag not in [256, 257, 258, 262, 277, 282, 283, 296]) or (kind not in TIFF_TYPES):
+            continue
+        code, size = TIFF_TYPES[kind]
+        if size * number > 4:
+            handle.seek(struct.unpack(order + 'I', value)[0])
+            value = handle.read(size * number)
+        values = struct.unpack(order + code * number, value[:size * number])
+        if kind == 5:
+            if values[1] == 0:
+                return None
+            values = [values[0] / values[1]]
+        tags[tag] = values
+
+    if (256 not in tags) or (257 not in tags) or (282 not in tags) or (262 not in tags):
+        return None
+    if tags[262][0] not in TIFF_PHOTOMETRIC:
+        return None
+
+    dpi = tags[282][0]
+    # A resolution unit of 3 means the resolution is given in pixels per centimeter.
+    if tags.get(296, [2])[0] == 3:
+        dpi = dpi * 2.54
+
+    info = {'depth':tags.get(258, [1])[0],
+            'dpi':int(round(dpi)),
+            'width':tags[256][0],
+            'height':tags[257][0],
+            'colorspace':TIFF_PHOTOMETRIC[tags[262][0]],
+            'format':'TIFF'}
+
+    return info
+
+def _read_pnm(handle):
+    """
+    Returns the properties of a PBM, PGM or PPM file, or None if the header cannot be
+    decoded or its maximum value is not that of a whole depth.  Only the header is read.
+    The maximum value is kept in the properties too, as 'maxval'.
+    """
+
+    magic = handle.read(2)
+    if magic not in PNM_FORMATS:
+        return None
+
+    # The header is the magic number followed by the width, height and (except for
+    # bitmaps) the maximum value, separated by whitespace and possibly comments.
+    if magic in [b'P1', b'P4']:
+        needed = 2
+    else:
+        needed = 3
+    fields = []
+    token = b''
+    while len(fields) < needed:
+        char = handle.read(1)
+        if char == b'':
+            return None
+        elif char == b'#':
+            handle.readline()
+        elif char.isspace():
+            if token != b'':
+                fields.append(token)
+                token = b''
+        elif char.isdigit():
+            token = token + char
+        else:
+            return None
+
+    fields = [int(x) for x in fields]
+    if needed == 2:
+        maxval = 1
+    else:
+        maxval = fields[2]
+    # Other maximum values are scaled to the nearest depth, which ImageMagick works out
+    # from the pixels themselves, so those files are left to it.
+    if maxval not in PNM_DEPTHS:
+        return None
+
+    if magic in [b'P3', b'P6']:
+        colorspace = 'sRGB'
+    else:
+        colorspace = 'Gray'
+
+    info = {'depth':PNM_DEPTHS[maxval],
+            'dpi':DEFAULT_DPI,
+            'width':fields[0],
+            'height':fields[1],
+            'colorspace':colorspace,
+            'format':PNM_FORMATS[magic],
+            'maxval':maxval}
+
+    return info
+
+def read_header(path):
+    """
+    Returns a dictionary of image properties (depth, dpi, width, height, colorspace and
+    format) read from the header of a TIFF or PNM file, or None if the file is some
+    other format or uses something the reader does not understand.
+    """
+
+    try:
+        with open(path, 'rb') as handle:
+            start = handle.read(2)
+            handle.seek(0)
+            if start in [b'II', b'MM']:
+                info = _read_tiff(handle)
+            elif start in PNM_FORMATS:
+                info = _read_pnm(handle)
+            else:
+                info = None
+    except (OSError, struct.error):
+        info = None
+
+    return info
+
+def get_info(path):
+    """
+    Returns a dictionary of image properties (depth, dpi, width, height, colorspace and
+    format).  The file header is read directly when possible, and ImageMagick is used
+    for everything else.
+    """
+
+    info = read_header(path)
+    if info is None:
+        info = utils.identify(path)
+
+    return info
+
+def read_pixels(path, threads=None):
+    """
+    Returns the pixels of an image as a numpy array of bytes, with a shape of (height,
+    width, 3).  PGM and PPM files with a maximum value of 255 are read directly, and
+    everything else (including other maximum values, whose samples would need scaling)
+    is decoded by ImageMagick in a single call, using at most threads threads.
+    """
+
+    info = None
+    with open(path, 'rb') as handle:
+        data = handle.read(2)
+        if data in [b'P5', b'P6']:
+            data = data + handle.read()
+            handle = io.BytesIO(data)
+            info = _read_pnm(handle)
+    if (info is None) or (info['maxval'] != 255):
+        data = utils.run(['convert', path, '-depth', '8', 'ppm:-'], capture=True, threads=threads)
+        handle = io.BytesIO(data)
+        info = _read_pnm(handle)
+        if (info is None) or (data[:2] not in [b'P5', b'P6']) or (info['maxval'] != 255):
+            raise ValueError('ImageMagick did not decode "{0}" as an 8 bit image.'.format(path))
+
+    if info['format'] == 'PPM':
+        channels = 3
+    else:
+        channels = 1
+    # _read_pnm() stops after the single whitespace character that ends the header.
+    start = handle.tell()
+    size = info['width'] * info['height'] * channels
+    pixels = numpy.frombuffer(data, numpy.uint8, size, start)
+    pixels = pixels.reshape((info['height'], info['width'], channels))
+    if channels == 1:
+        pixels = numpy.repeat(pixels, 3, axis=2)
+
+    return pixels
+
+def rle(mask):
+    """
+    Returns a bitonal image, given as a numpy array of booleans (True for black), in
+    djvulibre's RLE format.  Each row is a series of alternating white and black runs,
+    starting with a white one.
+    """
+
+    height, width = mask.shape
+
+    # Positions, in each row, where the colour changes from the pixel before (the pixel
+    # before the first being white).  Each row is given its own range of keys so that
+    # the whole image can be sorted at once.
+    padded = numpy.zeros((height, width + 1), numpy.int8)
+    padded[:, 1:] = mask
+    rows, columns = numpy.nonzero(numpy.diff(padded, axis=1))
+    stride = width + 1
+    lines = numpy.arange(height, dtype=numpy.int64) * stride
+    keys = numpy.concatenate([lines, rows * stride + columns, lines + width])
+    ends = numpy.concatenate([numpy.zeros(height + len(rows), bool), numpy.ones(height, bool)])
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    ends = ends[order]
+    # The gap between the end of one row and the start of the next is not a run.
+    runs = numpy.diff(keys)[~ends[:-1]]
+
+    # Runs too long for the format are split by a black (or white) run of no pixels.
+    if (len(runs) > 0) and (runs.max() > RLE_MAX):
+        split = []
+        for run in runs.tolist():
+            while run > RLE_MAX:
+                split.extend([RLE_MAX, 0])
+                run = run - RLE_MAX
+            split.append(run)
+        runs = numpy.array(split, numpy.int64)
+
+    short = runs < RLE_LONG
+    first = numpy.where(short, runs, RLE_LONG + (runs >> 8))
+    second = runs & 0xff
+    data = numpy.stack([first, second], axis=1).ravel()
+    keep = numpy.stack([numpy.ones(len(runs), bool), ~short], axis=1).ravel()
+    header = 'R4\n{0} {1}\n'.format(width, height).encode('ascii')
+
+    return header + data[keep].astype(numpy.uint8).tobytes()
+
+def separate(path, threads=None):
+    """
+    Returns a page in the format csepdjvu reads: its pure black pixels as an RLE
+    image (the text, in scantailor's mixed mode), followed by the whole page as a PPM
+    image (the background).  Requires numpy.  threads is passed on to read_pixels().
+    """
+
+    pixels = read_pixels(path, threads)
+    height, width = pixels.shape[:2]
+    mask = (pixels.max(axis=2) == 0)
+    header = 'P6\n{0} {1}\n255\n'.format(width, height).encode('ascii')
+
+    return rle(mask) + header + pixels.tobytes()
+
+def classify(path, info=None):
+    """
+    Returns what kind of page an image is: 'bitonal' (only black and white, even if it
+    is stored with more bits per pixel), 'gray', 'lowcolor' (no more than LOWCOLOR_MAX
+    colours) or 'color'.  info is the result of get_info(), if already known.  Without
+    numpy, only the file header is used, and pages are only bitonal if they are stored
+    with one bit per pixel.
+    """
+
+    if info is None:
+        info = get_info(path)
+    if info['depth'] == 1:
+        return 'bitonal'
+    if numpy is None:
+        if info['colorspace'] == 'Gray':
+            return 'gray'
+        return 'color'
+
+    pixels = read_pixels(path)
+    red = pixels[:, :, 0]
+    if ((red == pixels[:, :, 1]) & (red == pixels[:, :, 2])).all():
+        counts = numpy.bincount(red.ravel(), minlength=256)
+        if counts[1:255].sum() == 0:
+            return 'bitonal'
+        return 'gray'
+
+    # Colours are counted on a sample first, since most colour pages have far too many.
+    colors = (red.astype(numpy.uint32) << 16) | (pixels[:, :, 1].astype(numpy.uint32) << 8) | pixels[:, :, 2]
+    if len(numpy.unique(colors[::4, ::4])) > LOWCOLOR_MAX:
+        return 'color'
+    if len(numpy.unique(colors)) > LOWCOLOR_MAX:
+        return 'color'
+
+    return 'lowcolor'
+
+def write_pbm(path, outfile, threads=None):
+    """
+    Write an image that only has black and white pixels (see classify()) to outfile in
+    PBM format, which the bitonal encoders accept.  Requires numpy.  threads is passed
+    on to read_pixels().
+    """
+
+    pixels = read_pixels(path, threads)
+    height, width = pixels.shape[:2]
+    # PBM rows are padded to whole bytes, as numpy packs them.
+    bits = numpy.packbits(pixels[:, :, 0] == 0, axis=1)
+    with open(outfile, 'wb') as handle:
+        handle.write('P4\n{0} {1}\n'.format(width, height).encode('ascii'))
+        handle.write(bits.tobytes())
+
+    return None
@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Keeps track of completed work so that an interrupted run can be resumed.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+
+# Records are written out as soon as they are made, which is all it takes for them to
+# survive djvubind being killed.  Syncing them to disk as well, so that they survive a
+# crash of the system, is only done every SYNC_INTERVAL seconds, since a sync costs far
+# more than the record itself (especially on a network share).
+SYNC_INTERVAL = 10.0
+
+
+class Journal:
+    """
+    Records each completed unit of work (the analysis, ocr and encoding of a page) in
+    a scratch directory.  Files produced along the way, such as encoded pages, are kept
+    in the same directory.
+
+    Records are only trusted if the options of the run are the same as the ones that
+    made them, and if the page's image has not been modified since.
+    """
+
+    def __init__(self, directory, signature, resume=False):
+        self.directory = directory
+        self.filename = os.path.join(directory, 'journal')
+        self.signature = signature
+        self.records = {}
+        # The pages that each file in the scratch directory was recorded for.
+        self.files = {}
+        self.lock = threading.Lock()
+
+        if resume and os.path.isfile(self.filename):
+            self.load()
+        if len(self.records) == 0:
+            if os.path.isdir(self.directory):
+                shutil.rmtree(self.directory)
+            os.makedirs(self.directory)
+            with open(self.filename, 'w', encoding='utf8') as handle:
+                handle.write(json.dumps({'signature':self.signature}) + '\n')
+
+        self.handle = open(self.filename, 'a', encoding='utf8')
+        self.synced = time.time()
+
+    def _stamp(self, page):
+        info = os.stat(page.path)
+        return [info.st_size, info.st_mtime_ns]
+
+    def load(self):
+        """
+        Read the records of a previous run, if it was made with the same options.
+        """
+
+        with open(self.filename, 'r', encoding='utf8') as handle:
+            lines = handle.readlines()
+
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if header.get('signature') != self.signature:
+            return None
+
+        for line in lines[1:]:
+            # The last line might be incomplete if the previous run was killed while writing it.
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._add(record)
+
+        return None
+
+    def _add(self, record):
+        self.records[(record['stage'], record['path'])] = record
+        if 'file' in record['values']:
+            self.files.setdefault(record['values']['file'], set()).add(record['path'])
+
+        return None
+
+    def path(self, name):
+        """
+        Returns the path of a file named name in the scratch directory.
+        """
+
+        return os.path.join(self.directory, name)
+
+    def lookup(self, stage, page):
+        """
+        Returns the values recorded for the stage ('analyze', 'ocr' or 'encode') of a
+        page, or None if that work still needs to be done.
+        """
+
+        record = self.records.get((stage, page.path))
+        if record is None:
+            return None
+        if record['stamp'] != self._stamp(page):
+            return None
+        if ('file' in record['values']) and (not os.path.isfile(record['values']['file'])):
+            return None
+
+        return record['values']
+
+    def claimed(self, filename, paths):
+        """
+        Checks if a record gives filename to a page other than those of the images in
+        paths, so that it must not be written over.
+        """
+
+        with self.lock:
+            owners = self.files.get(filename, set())
+            return len(owners - set(paths)) > 0
+
+    def record(self, stage, page, values):
+        """
+        Record that the stage of a page is complete, along with its results.  The record
+        is written out before this returns, but only synced to disk every SYNC_INTERVAL
+        seconds.
+        """
+
+        record = {'stage':stage, 'path':page.path, 'stamp':self._stamp(page), 'values':values}
+        with self.lock:
+            self._add(record)
+            self.handle.write(json.dumps(record) + '\n')
+            self.handle.flush()
+            if time.time() - self.synced >= SYNC_INTERVAL:
+                os.fsync(self.handle.fileno())
+                self.synced = time.time()
+
+        return None
+
+    def finish(self):
+        """
+        Remove the scratch directory once the book is complete.
+        """
+
+        self.handle.close()
+        shutil.rmtree(self.directory)
+
+        return None
@@ -19,138 +19,196 @@ Perform OCR operations using various engines.
 """
 
 import difflib
+import io
+import json
 import os
 import re
-import shutil
-import subprocess
+import shlex
 import sys
+import threading
+import time
 
+from array import array
 from html.parser import HTMLParser
 
+from . import image
+from . import scratch
+from . import toolchain
+from . import trace
 from . import utils
 
 
-class BoundingBox(object):
+class Boxing(object):
     """
-    A rectangular portion of an image that contains something of value, such as
-    text or a collection of smaller bounding boxes.
+    The characters found on a page, with the word and line breaks between them.  Rather
+    than an object per character, the characters are kept in a single text buffer, each
+    of their coordinates in parallel arrays, and the breaks in a separate array of
+    positions.
 
         Attributes:
-            * perimeter (dictionary): xmax, xmin, ymax, ymin - integer values for the coordinates of the box.
-            * children (list): Either other bounding boxes or single character strings of each letter in the word.
+            * chars (io.StringIO): The characters, already escaped for djvused, so that
+              one character can take up several in the buffer.
+            * ends (array): Where each character ends in chars.
+            * xmin, ymin, xmax, ymax (array): The coordinates of each character's box.
+            * breaks (array): The number of characters that come before each break.
+            * kinds (array): The kind of each break, Boxing.SPACE or Boxing.NEWLINE.
+
+    Boxing can also be built from, and iterated as, the older list form of dictionaries
+    (char, xmin, ymin, xmax, ymax) mixed with the strings 'space' and 'newline'.
     """
 
-    def __init__(self):
-        self.perimeter = {'xmax':0, 'xmin':1000000000, 'ymax':0, 'ymin':1000000000}
-        self.children = []
-
-    def add_element(self, box):
+    SPACE = 0
+    NEWLINE = 1
+
+    def __init__(self, entries=None):
+        self.chars = io.StringIO()
+        self.ends = array('i')
+        self.xmin = array('i')
+        self.ymin = array('i')
+        self.xmax = array('i')
+        self.ymax = array('i')
+        self.breaks = array('i')
+        self.kinds = array('b')
+
+        if entries is not None:
+            self.extend(entries)
+
+    def __len__(self):
+        return len(self.ends) + len(self.breaks)
+
+    def __iter__(self):
+        names = {self.SPACE:'space', self.NEWLINE:'newline'}
+        text = self.chars.getvalue()
+        i = 0
+        for position, kind in zip(self.breaks, self.kinds):
+            while i < position:
+                yield {'char':self.text(i, i+1, text), 'xmin':self.xmin[i], 'ymin':self.ymin[i], 'xmax':self.xmax[i], 'ymax':self.ymax[i]}
+                i = i + 1
+            yield names[kind]
+        while i < len(self.ends):
+            yield {'char':self.text(i, i+1, text), 'xmin':self.xmin[i], 'ymin':self.ymin[i], 'xmax':self.xmax[i], 'ymax':self.ymax[i]}
+            i = i + 1
+
+    def text(self, start=0, end=None, text=None):
         """
-        Adds a smaller BoundingBox.
-
-            Arguments:
-                * box (BoundingBox):
+        Returns the characters from start up to end (by default, to the last one), as
+        they are escaped for djvused.  text is the contents of chars, if already known.
         """
 
-        if box.perimeter['xmin'] < self.perimeter['xmin']:
-            self.perimeter['xmin'] = box.perimeter['xmin']
-        if box.perimeter['ymin'] < self.perimeter['ymin']:
-            self.perimeter['ymin'] = box.perimeter['ymin']
-        if box.perimeter['xmax'] > self.perimeter['xmax']:
-            self.perimeter['xmax'] = box.perimeter['xmax']
-        if box.perimeter['ymax'] > self.perimeter['ymax']:
-            self.perimeter['ymax'] = box.perimeter['ymax']
-        self.children.append(box)
+        if text is None:
+            text = self.chars.getvalue()
+        if end is None:
+            end = len(self.ends)
+        if end <= start:
+            return ''
+        first = 0
+        if start > 0:
+            first = self.ends[start-1]
 
-        return None
+        return text[first:self.ends[end-1]]
 
-    def sanity_check(self):
+    def add_break(self, kind):
         """
-        Verifies that the x/y min values are not greater than the x/y max values.
-
-            Raises:
-                * ValueError: A min is greater than a max.  Either there was bad input nothing was added to the bounding box.
+        Adds a word break ('space') or line break ('newline') after the last character.
         """
 
-        if (self.perimeter['xmin'] > self.perimeter['xmax']) or (self.perimeter['ymin'] > self.perimeter['ymax']):
-            raise ValueError('Boxing information is impossible (x/y min exceed x/y max).')
+        if kind == 'space':
+            self.kinds.append(self.SPACE)
+        elif kind == 'newline':
+            self.kinds.append(self.NEWLINE)
+        else:
+            raise ValueError('Unknown break "{0}".'.format(kind))
+        self.breaks.append(len(self.ends))
+
         return None
 
+    def add_char(self, char, xmin, ymin, xmax, ymax):
+        """
+        Adds a character and its bounding box.
+        """
 
-class djvuWordBox(BoundingBox):
-    """
-    BoundingBox of a single word.  See :py:meth:`~djvubind.ocr.BoundingBox`
-    """
+        self.chars.write(char)
+        self.ends.append(self.chars.tell())
+        self.xmin.append(xmin)
+        self.ymin.append(ymin)
+        self.xmax.append(xmax)
+        self.ymax.append(ymax)
 
-    def __init__(self):
-        BoundingBox.__init__(self)
+        return None
 
-    def add_character(self, boxing):
+    def extend(self, entries):
         """
-        Adds a character to the BoundingBox.
-
-            Arguments:
-                * boxing (dictionary): char, xmax, xmin, ymax, ymin.
+        Adds entries in the older list form.
         """
 
-        if boxing['xmin'] < self.perimeter['xmin']:
-            self.perimeter['xmin'] = boxing['xmin']
-        if boxing['ymin'] < self.perimeter['ymin']:
-            self.perimeter['ymin'] = boxing['ymin']
-        if boxing['xmax'] > self.perimeter['xmax']:
-            self.perimeter['xmax'] = boxing['xmax']
-        if boxing['ymax'] > self.perimeter['ymax']:
-            self.perimeter['ymax'] = boxing['ymax']
-        self.children.append(boxing['char'])
+        for entry in entries:
+            if entry in ['space', 'newline']:
+                self.add_break(entry)
+            else:
+                self.add_char(entry['char'], entry['xmin'], entry['ymin'], entry['xmax'], entry['ymax'])
 
         return None
 
-    def encode(self):
-        self.sanity_check()
-        return '(word {0} {1} {2} {3} "{4}")'.format(self.perimeter['xmin'], self.perimeter['ymin'], self.perimeter['xmax'], self.perimeter['ymax'], ''.join(self.children))
-
-class djvuLineBox(BoundingBox):
-    """
-    BoundingBox of a single line.  See :py:meth:`~djvubind.ocr.BoundingBox`
-    """
+    def flip(self, height):
+        """
+        Inverts the y-axis of every box, for an image that is height pixels high.  hocr
+        counts from the top of the image, while djvu counts from the bottom.
+        """
 
-    def __init__(self):
-        BoundingBox.__init__(self)
+        ymin = self.ymin
+        self.ymin = array('i', [height - y for y in self.ymax])
+        self.ymax = array('i', [height - y for y in ymin])
 
-    def encode(self):
-        # This is a hackish solution for when a line happens to be blank (only cuneiform hocr?).
-        # Something here with BoundingBox needs to be thought through better.
-        if (self.perimeter['xmin'] == 1000000000) and (self.perimeter['ymin'] == 1000000000):
-            return ''
-        self.sanity_check()
-        line = '(line {0} {1} {2} {3}'.format(self.perimeter['xmin'], self.perimeter['ymin'], self.perimeter['xmax'], self.perimeter['ymax'])
-        words = '\n    '.join([x.encode() for x in self.children])
-        return line+'\n    '+words+')'
+        return None
 
+    def last(self):
+        """
+        Returns the last entry: 'space', 'newline', 'char' or None if there is nothing.
+        """
 
-class djvuPageBox(BoundingBox):
-    """
-    BoundingBox of a single page.  See :py:meth:`~djvubind.ocr.BoundingBox`
-    """
+        if (len(self.breaks) > 0) and (self.breaks[-1] == len(self.ends)):
+            if self.kinds[-1] == self.SPACE:
+                return 'space'
+            else:
+                return 'newline'
+        elif len(self.ends) > 0:
+            return 'char'
+        else:
+            return None
 
-    def __init__(self):
-        BoundingBox.__init__(self)
 
-    def encode(self):
-        self.sanity_check()
-        page = '(page {0} {1} {2} {3}'.format(self.perimeter['xmin'], self.perimeter['ymin'], self.perimeter['xmax'], self.perimeter['ymax'])
-        lines = '\n  '.join([x.encode() for x in self.children])
-        return page+'\n  '+lines+')'
+class hocrParser(HTMLParser):
+    """
+    Reads the character boxing from hocr output in a single pass over the document.
+    Each element of interest is collected from the parser's callbacks as it goes by,
+    and turned into boxing as soon as it is complete.
 
+    A document can hold several pages (ocr_page elements).  Each one gets its own
+    boxing, which is kept in self.pages along with the name of its image.  self.boxing
+    is the boxing of the last page.
+    """
 
-class hocrParser(HTMLParser):
+    # Characters that need to be escaped for djvused.
+    subst = {'"': '\\"', "'":"\\'", '\\': '\\\\'}
 
     def __init__(self):
-        HTMLParser.__init__(self)
-        self.boxing = []
+        # Entities are collected as written and replaced later, like the rest of djvubind does.
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.boxing = Boxing()
+        self.pages = []
         self.version = '0.8.0'
         self.data = ''
 
+        # The element currently being collected: 'char' (0.8.0), 'line' (1.0.0) or
+        # 'word' (tesseract), or None.
+        self.element = None
+        self.box = None
+        self.text = []
+        self.positions = None
+        self.newlines = 0
+        # Whether a span just ended, in which case a following space is a word break.
+        self.after_span = False
+
     def parse(self, data):
         self.data = data
         if "class='ocr_cinfo'" in self.data:
@@ -160,106 +218,141 @@ class hocrParser(HTMLParser):
         self.feed(data)
         return None
 
-    def handle_starttag(self, tag, attrs):
-        if self.version == '0.8.0':
-            if (tag == 'br') or (tag == 'p'):
-                if (len(self.boxing) > 0):
-                    self.boxing.append('newline')
-            elif (tag == 'span'):
-                # Get the whole element (<span title="bbox n n n n">x</span>), not just the tag.
-                element = {}
-                element['start'] = self.data.find(self.get_starttag_text())
-                element['end'] = self.data.find('>', element['start'])
-                element['end'] = self.data.find('>', element['end']+1)
-                element['end'] = element['end'] + 1
-                element['text'] = self.data[element['start']:element['end']]
-                pos = element['text'].find('>') + 1
-                element['char'] = element['text'][pos:pos+1]
-
-                # Figure out the boxing information from the title attribute.
-                attrs = dict(attrs)['title']
-                attrs = attrs.split()[1:]
-                positions = {'xmin':int(attrs[0]), 'ymin':int(attrs[1]), 'xmax':int(attrs[2]), 'ymax':int(attrs[3])}
-                positions['char'] = element['char']
+    def add_char(self, char, section):
+        """
+        Add the boxing of a single character, or a word break if it is a space.
+        """
 
-                # Escape special characters
-                subst = {'"': '\\"', "'":"\\'", '\\': '\\\\'}
-                if positions['char'] in subst.keys():
-                    positions['char'] = subst[positions['char']]
-                self.boxing.append(positions)
-
-                # A word break is indicated by a space after the </span> tag.
-                if (self.data[element['end']:element['end']+1] == ' '):
-                    self.boxing.append('space')
-        elif self.version == '1.0.0':
-            if (tag == 'br') or (tag == 'p'):
-                if (len(self.boxing) > 0):
-                    self.boxing.append('newline')
-            elif (tag == 'span') and (('class', 'ocr_line') in attrs):
-                # Get the whole element, not just the tag.
-                element = {}
-                element['complete'] = re.search('{0}(.*?)</span>'.format(self.get_starttag_text()), self.data).group(0)
-                if "<span class='ocr_cinfo'" not in element['complete']:
-                    return None
-                element['text'] = re.search('">(.*)<span', element['complete']).group(1)
-                element['text'] = re.sub('<[\w\/\.]*>', '', element['text'])
-                element['text'] = utils.replace_html_codes(element['text'])
-                element['positions'] = re.search('title="x_bboxes (.*) ">', element['complete']).group(1)
-                element['positions'] = [int(item) for item in element['positions'].split()]
+        # A word break is indicated by a space (go figure).
+        if (char == ' '):
+            self.boxing.add_break('space')
+            return None
+
+        # Escape special characters
+        if char in self.subst:
+            char = self.subst[char]
+        self.boxing.add_char(char, section[0], section[1], section[2], section[3])
+
+        return None
 
+    def finish_element(self):
+        """
+        Turn the element that was just collected into boxing.
+        """
+
+        text = utils.replace_html_codes(''.join(self.text))
+        if self.element == 'line':
+            # Lines without character boxes are skipped.
+            if self.positions is not None:
                 i = 0
-                for char in element['text']:
-                    if element['positions'][i:i+4] == []:
+                for char in text:
+                    if self.positions[i:i+4] == []:
                         continue
-                    section = element['positions'][i:i+4]
-                    positions = {'char':char, 'xmin':section[0], 'ymin':section[1], 'xmax':section[2], 'ymax':section[3]}
+                    self.add_char(char, self.positions[i:i+4])
                     i = i+4
+        elif self.element == 'word':
+            # Tesseract only gives the boxing of the whole word.
+            for char in text:
+                if self.positions[0:4] == []:
+                    continue
+                self.add_char(char, self.positions[0:4])
+            self.boxing.add_break('space')
 
-                    # A word break is indicated by a space (go figure).
-                    if (char == ' '):
-                        self.boxing.append('space')
-                        continue
+        self.element = None
+        self.text = []
+        self.positions = None
+
+        # Line breaks found inside the element go after it.
+        while self.newlines > 0:
+            if (len(self.boxing) > 0):
+                self.boxing.add_break('newline')
+            self.newlines = self.newlines - 1
 
-                    # Escape special characters
-                    subst = {'"': '\\"', "'":"\\'", '\\': '\\\\'}
-                    if positions['char'] in subst.keys():
-                        positions['char'] = subst[positions['char']]
-                    self.boxing.append(positions)
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        self.after_span = False
+
+        if (tag == 'div') and (('class', 'ocr_page') in attrs):
+            self.boxing = Boxing()
+            name = re.search(r'image "([^"]*)"', dict(attrs).get('title', ''))
+            if name is not None:
+                name = name.group(1)
+            self.pages.append((name, self.boxing))
+        elif (tag == 'br') or (tag == 'p'):
+            if self.element in ['line', 'cinfo', 'word']:
+                self.newlines = self.newlines + 1
+            elif (len(self.boxing) > 0):
+                self.boxing.add_break('newline')
+        elif tag != 'span':
+            pass
+        elif self.version == '0.8.0':
+            # Figure out the boxing information from the title attribute.  The character
+            # itself is the first one inside the span, and is added along with it.
+            title = dict(attrs)['title'].split()[1:]
+            self.box = [int(item) for item in title[0:4]]
+            self.element = 'char'
+        elif self.version == '1.0.0':
+            if ('class', 'ocr_line') in attrs:
+                self.element = 'line'
+            elif (self.element == 'line') and (('class', 'ocr_cinfo') in attrs):
+                # The text of the line ends where its character boxes begin.
+                title = dict(attrs)['title'].split()[1:]
+                self.positions = [int(item) for item in title]
+                self.element = 'cinfo'
         elif self.version == 'tesseract':
-            if (tag == 'br') or (tag == 'p'):
-                if (len(self.boxing) > 0):
-                    self.boxing.append('newline')
-            elif (tag == 'span') and (('class', 'ocrx_word') in attrs):
-                # Get the whole element, not just the tag.
-                element = {}
-                element['complete'] = re.search('{0}(.*?)</span>'.format(self.get_starttag_text()), self.data).group(0)
-                element['text'] = re.search('\'>(.*?)</span', element['complete']).group(1)
-                element['text'] = re.sub('<[\w\/\.]*>', '', element['text'])
-                element['text'] = utils.replace_html_codes(element['text'])
-                element['positions'] = re.search('bbox ([0-9\s]*)', element['complete']).group(1)
-                element['positions'] = [int(item) for item in element['positions'].split()]
+            if ('class', 'ocrx_word') in attrs:
+                title = re.search(r'bbox ([0-9\s]*)', dict(attrs)['title']).group(1)
+                self.positions = [int(item) for item in title.split()]
+                self.element = 'word'
 
-                i = 0
-                for char in element['text']:
-                    if element['positions'][i:i+4] == []:
-                        continue
-                    section = element['positions'][i:i+4]
-                    positions = {'char':char, 'xmin':section[0], 'ymin':section[1], 'xmax':section[2], 'ymax':section[3]}
-                    #i = i+4
+        return None
 
-                    # A word break is indicated by a space (go figure).
-                    if (char == ' '):
-                        self.boxing.append('space')
-                        continue
+    def handle_endtag(self, tag):
+        self.after_span = False
 
-                    # Escape special characters
-                    subst = {'"': '\\"', "'":"\\'", '\\': '\\\\'}
-                    if positions['char'] in subst.keys():
-                        positions['char'] = subst[positions['char']]
-                    self.boxing.append(positions)
+        if tag != 'span':
+            return None
+
+        if self.element == 'char':
+            # An empty span has no character to place.
+            self.box = None
+            self.element = None
+            self.after_span = True
+        elif self.element == 'cinfo':
+            self.element = 'line'
+            self.finish_element()
+        elif self.element is not None:
+            self.finish_element()
+
+        return None
+
+    def handle_data(self, data):
+        if self.after_span:
+            # A word break is indicated by a space after the </span> tag.
+            self.after_span = False
+            if data.startswith(' '):
+                self.boxing.add_break('space')
+
+        if self.element == 'char':
+            if (self.box is not None) and (data != ''):
+                # Escape special characters
+                char = data[0]
+                if char in self.subst:
+                    char = self.subst[char]
+                self.boxing.add_char(char, self.box[0], self.box[1], self.box[2], self.box[3])
+                self.box = None
+        elif self.element in ['line', 'word']:
+            self.text.append(data)
+
+        return None
 
-                self.boxing.append('space')
+    def handle_entityref(self, name):
+        self.handle_data('&{0};'.format(name))
+        return None
 
+    def handle_charref(self, name):
+        self.handle_data('&#{0};'.format(name))
         return None
 
 
@@ -269,56 +362,84 @@ class Cuneiform(object):
     """
 
     def __init__(self, options):
-        if not utils.is_executable('cuneiform'):
+        tool = toolchain.find('cuneiform')
+        if tool is None:
             raise OSError('Cuneiform is either not installed or not in the configured path.')
 
+        # Cuneiform has no dependable way of reporting its version, so the executable
+        # itself stands in for it when results of different versions need to be told apart.
+        size, mtime = tool.stamp
+
+        self.name = 'cuneiform'
+        self.version = '{0}-{1}'.format(size, mtime // 1000000000)
+        # What tells the results of different versions apart, for the ocr cache.
+        self.release = self.version
         self.options = options
+        # Whether several pages can be done at once with analyze_batch().
+        self.batch = False
+        # How many threads cuneiform may use, or None for no limit.
+        self.threads = None
 
-    def analyze(self, filename):
+    def hocr(self, filename):
         """
-        Performs OCR analysis on the image and returns a djvuPageBox object.
+        Runs cuneiform on the image and returns its hocr output, or None if cuneiform
+        crashed.
         """
 
-        status = utils.simple_exec('cuneiform -f hocr -o "{0}.hocr" {1} "{0}"'.format(filename, self.options))
-        if status != 0:
-            if status == -6:
-                # Cuneiform seems to have a buffer flow on every other image, and even more without the --singlecolumn option.
-                msg = '\nwrn: cuneiform encountered a buffer overflow on "{0}".'.format(os.path.split(filename)[1])
-                msg = utils.color(msg, 'red')
-                print(msg, file=sys.stderr)
-            else:
-                # Cuneiform crashes on blank images (exit status 1, message about failing to detect something).
-                # They do not consider this behavior a bug. See https://bugs.launchpad.net/cuneiform-linux/+bug/445357
-                # Also, it seems that <=cuneiform-0.7.0 can only process bmp images.
-                msg = 'wrn: cuneiform crashed on "{0}".'.format(os.path.split(filename)[1])
-                msg = utils.color(msg, 'red')
-                print(msg, file=sys.stderr)
-            return []
-
-        with open('{0}.hocr'.format(filename), 'r', encoding='utf8') as handle:
-            text = handle.read()
-
-        # Clean up excess files.
-        basename = os.path.split(filename)[1]
-        basename = basename.split('.')[:-1]
-        basename = '.'.join(basename)
-        if os.path.isdir(basename+'_files'):
-            shutil.rmtree(basename+'_files')
-        os.remove(filename+'.hocr')
-
-        parser = hocrParser()
-        parser.parse(text)
+        with scratch.Workspace('cuneiform') as work:
+            status = utils.run(['cuneiform', '-f', 'hocr', '-o', work.path('page.hocr')] + shlex.split(self.options) + [filename], check=False, threads=self.threads)
+            if status != 0:
+                if status == -6:
+                    # Cuneiform seems to have a buffer flow on every other image, and even more without the --singlecolumn option.
+                    msg = '\nwrn: cuneiform encountered a buffer overflow on "{0}".'.format(os.path.split(filename)[1])
+                    msg = utils.color(msg, 'red')
+                    print(msg, file=sys.stderr)
+                else:
+                    # Cuneiform crashes on blank images (exit status 1, message about failing to detect something).
+                    # They do not consider this behavior a bug. See https://bugs.launchpad.net/cuneiform-linux/+bug/445357
+                    # Also, it seems that <=cuneiform-0.7.0 can only process bmp images.
+                    msg = 'wrn: cuneiform crashed on "{0}".'.format(os.path.split(filename)[1])
+                    msg = utils.color(msg, 'red')
+                    print(msg, file=sys.stderr)
+                return None
+
+            with open(work.path('page.hocr'), 'r', encoding='utf8') as handle:
+                text = handle.read()
+
+        # Any images cuneiform extracts go to a "page_files" directory next to its
+        # output, and are removed along with the workspace.
+        return text
+
+    def analyze(self, filename, height=None):
+        """
+        Performs OCR analysis on the image and returns a Boxing object.  height is
+        the height of the image in pixels, if it is already known.
+        """
+
+        text = self.hocr(filename)
+        if text is None:
+            return Boxing()
 
         # Cuneiform hocr inverts the y-axis compared to what djvu expects.  The total height of the
         # image is needed to invert the values.
-        height = int(utils.execute('identify -format %H "{0}"'.format(filename), capture=True))
-        for entry in parser.boxing:
-            if entry not in ['space', 'newline']:
-                ymin, ymax = entry['ymin'], entry['ymax']
-                entry['ymin'] = height - ymax
-                entry['ymax'] = height - ymin
+        if height is None:
+            height = image.get_info(filename)['height']
+
+        return parse_hocr(text, [height])[0]
 
-        return parser.boxing
+    def read(self, filename, height=None, pool=None):
+        """
+        Performs OCR analysis on the image and returns its text in djvused format.  The
+        hocr is parsed by pool (a concurrent.futures executor) if one is given.
+        """
+
+        text = self.hocr(filename)
+        if text is None:
+            return ''
+        if height is None:
+            height = image.get_info(filename)['height']
+
+        return hocr_to_djvused(text, [height], pool=pool)[0]
 
 
 class Tesseract(object):
@@ -327,212 +448,374 @@ class Tesseract(object):
     """
 
     def __init__(self, options):
-        if not utils.is_executable('tesseract'):
+        tool = toolchain.find('tesseract')
+        if tool is None:
             raise OSError('Tesseract is either not installed or not in the configured path.')
 
-        sub = subprocess.Popen('tesseract --version', shell=True, stderr=subprocess.PIPE)
-        sub.wait()
-        version = str(sub.stderr.read())
-        version = version.split('\\n')[0]
-        version = version.split()[-1]
-        version = version.split('.')[0]
-
-        self.version = int(version)
+        self.name = 'tesseract'
+        self.path = tool.path
+        self.version = toolchain.major(tool.version)
+        # Minor versions change the results too (new models, for one), so the ocr cache
+        # tells them apart by the full version, along with what the version can do.
+        self.release = '{0} {1}'.format(tool.version, json.dumps(tool.features, sort_keys=True))
         self.options = options
+        # Whether several pages can be done at once with hocr_batch().
+        self.batch = tool.features['multifile']
+        # How many threads tesseract may use, or None for no limit.
+        self.threads = None
 
-    def _correct_boxfile(self, boxdata, text):
-        """
-        Reconciles Tesseract's boxfile data with it's plain text data.
-
-        The Tesseract boxfile does not include information like spacing, which is kinda important
-        since we want to know where one word ends and the next begins.  The plain textfile will
-        give that information, but sometimes its content does not exactly match the boxfile.  So we
-        do our best to merge those two pieces of data together and "fix" the boxfile to match the
-        textfile.
-        """
-
-        # Convert the boxing information into a plain text string with no bounding information.
-        boxtext = ''
-        for entry in boxdata:
-            boxtext = boxtext + entry['char']
-        # Remove spacing and newlines from the readable text because the boxing data doesn't have those.
-        text = text.replace(' ', '')
-        text = text.replace('\n', '')
-
-        # Figure out what changes are needed, but don't do them immediately since it would
-        # change the boxdata index and screw up the next action.
-        diff = difflib.SequenceMatcher(None, boxtext, text)
-        queu = []
-        for action, a_start, a_end, b_start, b_end in diff.get_opcodes():
-            entry = boxdata[a_start]
-            item = {'action':action, 'target':entry, 'boxtext':boxtext[a_start:a_end], 'text':text[b_start:b_end]}
-            queu.append(item)
-
-        # Make necessary changes
-        for change in queu:
-            if (change['action'] == 'replace'):
-                if (len(change['boxtext']) == 1) and (len(change['text']) == 1):
-                    index = boxdata.index(change['target'])
-                    boxdata[index]['char'] = change['text']
-                elif (len(change['boxtext']) > 1) and (len(change['text']) == 1):
-                    # Combine the boxing data
-                    index = boxdata.index(change['target'])
-                    new = {'char':'', 'xmin':0, 'ymin':0, 'xmax':0, 'ymax':0}
-                    new['char'] = change['text']
-                    new['xmin'] = min([x['xmin'] for x in boxdata[index:index+len(change['boxtext'])]])
-                    new['ymin'] = min([x['ymin'] for x in boxdata[index:index+len(change['boxtext'])]])
-                    new['xmax'] = min([x['xmax'] for x in boxdata[index:index+len(change['boxtext'])]])
-                    new['ymax'] = min([x['ymax'] for x in boxdata[index:index+len(change['boxtext'])]])
-                    del(boxdata[index:index+len(change['boxtext'])])
-                    boxdata.insert(index, new)
-                elif (len(change['boxtext']) == 1) and (len(change['text']) > 1):
-                    # Use the same boxing data.  Will djvused complain that character
-                    # boxes overlap?
-                    index = boxdata.index(change['target'])
-                    del(boxdata[index])
-                    i = 0
-                    for char in list(change['text']):
-                        new = {'char':char, 'xmin':change['target']['xmin'], 'ymin':change['target']['ymin'], 'xmax':change['target']['xmax'], 'ymax':change['target']['ymax']}
-                        boxdata.insert(index+i, new)
-                        i = i + 1
-                elif (len(change['boxtext']) > 1) and (len(change['text']) > 1):
-                    if (len(change['boxtext']) == len(change['text'])):
-                        index = boxdata.index(change['target'])
-                        for char in list(change['text']):
-                            boxdata[index]['char'] = char
-                            index = index + 1
-                    else:
-                        # Delete the boxdata and replace with the plain text data
-                        index = boxdata.index(change['target'])
-                        deletions = boxdata[index:index+len(change['boxtext'])]
-                        for target in deletions:
-                            boxdata.remove(target)
-
-                        i = 0
-                        for char in list(change['text']):
-                            new = {'char':char, 'xmin':change['target']['xmin'], 'ymin':change['target']['ymin'], 'xmax':change['target']['xmax'], 'ymax':change['target']['ymax']}
-                            boxdata.insert(index+i, new)
-                            i = i + 1
-            elif (change['action'] == 'delete'):
-                index = boxdata.index(change['target'])
-                deletions = boxdata[index:index+len(change['boxtext'])]
-                for target in deletions:
-                    boxdata.remove(target)
-            elif (change['action'] == 'insert'):
-                # *Don't* use the boundaries of previous and next characters to guess at a boundary
-                # box.  Things would be ugly if the next character happened to be on a new line.
-                # Just duplicate the boundaries of the previous character
-                index = boxdata.index(change['target'])
-                i = 0
-                for char in list(change['text']):
-                    new = {'char':char, 'xmin':change['target']['xmin'], 'ymin':change['target']['ymin'], 'xmax':change['target']['xmax'], 'ymax':change['target']['ymax']}
-                    boxdata.insert(index+i, new)
-                    i = i + 1
+    def hocr(self, filename):
+        """
+        Runs tesseract (3.0 or later) on the image and returns its hocr output.
+        """
+
+        with scratch.Workspace('tesseract') as work:
+            utils.run([self.path, filename, work.path('page')] + shlex.split(self.options) + ['hocr'], threads=self.threads)
+            with open(work.path('page.hocr'), 'r', encoding='utf8') as handle:
+                text = handle.read()
 
-        return boxdata
+        return text
 
-    def analyze(self, filename):
+    def analyze(self, filename, height=None):
         """
-        Performs OCR analysis on the image and returns a djvuPageBox object.
+        Performs OCR analysis on the image and returns a Boxing object.  height is
+        the height of the image in pixels, if it is already known.
         """
 
         if self.version >= 3:
-            basename = os.path.split(filename)[1].split('.')[0]
-            tesseractpath = utils.get_executable_path('tesseract')
+            text = self.hocr(filename)
 
-            utils.execute('{0} "{1}" "{2}" {3} hocr'.format(tesseractpath, filename, basename, self.options))
+            # hocr inverts the y-axis compared to what djvu expects.  The total height of the
+            # image is needed to invert the values.
+            if height is None:
+                height = image.get_info(filename)['height']
+
+            return parse_hocr(text, [height])[0]
+        else:
+            with scratch.Workspace('tesseract') as work:
+                utils.run([self.path, filename, work.path('box')] + shlex.split(self.options) + ['batch', 'makebox'], threads=self.threads)
+
+                # tesseract-3.00 changed the .txt extension to .box so check which file was created.
+                if os.path.exists(work.path('box.txt')):
+                    boxfilename = work.path('box.txt')
+                else:
+                    boxfilename = work.path('box.box')
+
+                with open(boxfilename, 'r', encoding='utf8') as handle:
+                        boxfile = handle.read()
+
+                utils.run([self.path, filename, work.path('txt')] + shlex.split(self.options) + ['batch'], threads=self.threads)
+                with open(work.path('txt.txt'), 'r', encoding='utf8') as handle:
+                    text = handle.read()
+
+            boxdata = parse_boxfile(boxfile)
+            boxdata = correct_boxfile(boxdata, text)
+            boxing = merge_boxfile(boxdata, text, filename)
+
+            return boxing
 
-            with open('{0}.hocr'.format(basename), 'r') as handle:
+    def read(self, filename, height=None, pool=None):
+        """
+        Performs OCR analysis on the image and returns its text in djvused format.  The
+        hocr is parsed by pool (a concurrent.futures executor) if one is given.
+        """
+
+        if self.version < 3:
+            return translate(self.analyze(filename, height))
+
+        text = self.hocr(filename)
+        if height is None:
+            height = image.get_info(filename)['height']
+
+        return hocr_to_djvused(text, [height], pool=pool)[0]
+
+    def hocr_batch(self, filenames):
+        """
+        Runs a single tesseract process on several images, so that the language data is
+        only loaded once, and returns the multipage hocr output.
+        """
+
+        with scratch.Workspace('tesseract') as work:
+            with open(work.path('batch_list.txt'), 'w', encoding='utf8') as handle:
+                handle.write('\n'.join([os.path.abspath(filename) for filename in filenames]) + '\n')
+            utils.run([self.path, work.path('batch_list.txt'), work.path('batch')] + shlex.split(self.options) + ['hocr'], threads=self.threads)
+            with open(work.path('batch.hocr'), 'r', encoding='utf8') as handle:
                 text = handle.read()
 
-            # Clean up excess files.
-            #os.remove(basename+'.hocr')
+        return text
+
+    def analyze_batch(self, filenames, heights=None):
+        """
+        Performs OCR analysis on several images with a single tesseract process.  Returns
+        a list of Boxing objects, in the same order as filenames.  heights are the
+        heights of the images in pixels, where they are already known.
+        """
+
+        heights = _heights(filenames, heights)
+        names = [os.path.abspath(filename) for filename in filenames]
 
-            parser = hocrParser()
-            parser.parse(text)
+        return parse_hocr(self.hocr_batch(filenames), heights, names)
 
-            # hocr inverts the y-axis compared to what djvu expects.  The total height of the
-            # image is needed to invert the values.
-            height = int(utils.execute('identify -format %H "{0}"'.format(filename), capture=True))
-            for entry in parser.boxing:
-                if entry not in ['space', 'newline']:
-                    ymin, ymax = entry['ymin'], entry['ymax']
-                    entry['ymin'] = height - ymax
-                    entry['ymax'] = height - ymin
-
-            return parser.boxing
-        else:
-            basename = os.path.split(filename)[1].split('.')[0]
-            tesseractpath = utils.get_executable_path('tesseract')
+    def read_batch(self, filenames, heights=None, pool=None):
+        """
+        Like analyze_batch(), but returns the text of each image in djvused format.  The
+        hocr is parsed by pool (a concurrent.futures executor) if one is given.
+        """
+
+        heights = _heights(filenames, heights)
+        names = [os.path.abspath(filename) for filename in filenames]
+
+        return hocr_to_djvused(self.hocr_batch(filenames), heights, names, pool)
+
+
+def _heights(filenames, heights=None):
+    """
+    Returns the heights of the images, reading the ones that are not already known.
+    """
+
+    if heights is None:
+        heights = [None] * len(filenames)
+    heights = list(heights)
+    for index, height in enumerate(heights):
+        if height is None:
+            heights[index] = image.get_info(filenames[index])['height']
+
+    return heights
+
+def parse_hocr(data, heights, names=None):
+    """
+    Parses hocr output into a list of Boxing objects, one for each of the given image
+    heights, which are needed to invert the y-axis (hocr counts from the top, djvu from
+    the bottom).  A multipage document needs the names of its images, in the same order
+    as heights.
+    """
+
+    parser = hocrParser()
+    parser.parse(data)
+
+    if names is None:
+        parser.boxing.flip(heights[0])
+        return [parser.boxing]
+
+    if len(parser.pages) != len(names):
+        raise ValueError('tesseract returned {0} page(s) for {1} image(s).'.format(len(parser.pages), len(names)))
+
+    # Each page names its image, which is used to match it up when possible.
+    # Otherwise (some pages do not name theirs, for one), the pages are in the same
+    # order as the list.
+    order = list(range(len(names)))
+    found = [name for name, boxing in parser.pages]
+    if (None not in found) and (sorted(found) == sorted(names)) and (len(set(names)) == len(names)):
+        order = [names.index(name) for name in found]
 
-            utils.execute('{0} "{1}" "{2}_box" {3} batch makebox'.format(tesseractpath, filename, basename, self.options))
+    results = [None] * len(names)
+    for index, page in zip(order, parser.pages):
+        boxing = page[1]
+        boxing.flip(heights[index])
+        results[index] = boxing
 
-            # tesseract-3.00 changed the .txt extension to .box so check which file was created.
-            if os.path.exists(basename + '_box.txt'):
-                boxfilename = basename + '_box.txt'
+    return results
+
+def _hocr_to_djvused(data, heights, names=None):
+    # The times of each step are returned for tracing, since this may run in another process.
+    start = time.time()
+    boxings = parse_hocr(data, heights, names)
+    middle = time.time()
+    texts = [translate(boxing) for boxing in boxings]
+    end = time.time()
+
+    return texts, [start, middle, end], os.getpid(), threading.get_ident()
+
+def hocr_to_djvused(data, heights, names=None, pool=None):
+    """
+    Parses hocr output (see parse_hocr()) and translates each page into djvused format.
+    With a pool (a concurrent.futures executor), the work is done by one of its workers,
+    and only the hocr and the resulting text pass between processes.
+    """
+
+    if pool is None:
+        texts, times, pid, tid = _hocr_to_djvused(data, heights, names)
+    else:
+        texts, times, pid, tid = pool.submit(_hocr_to_djvused, data, heights, names).result()
+
+    trace.complete('hocr parse', 'ocr', times[0], times[1], {'pages':len(heights)}, pid, tid)
+    trace.complete('translate', 'ocr', times[1], times[2], {'pages':len(heights)}, pid, tid)
+
+    return texts
+
+def correct_boxfile(boxdata, text):
+    """
+    Reconciles Tesseract's boxfile data with it's plain text data.
+
+    The Tesseract boxfile does not include information like spacing, which is kinda important
+    since we want to know where one word ends and the next begins.  The plain textfile will
+    give that information, but sometimes its content does not exactly match the boxfile.  So we
+    do our best to merge those two pieces of data together and "fix" the boxfile to match the
+    textfile.
+
+    The corrected boxing is built in a single pass over the differences, rather than by
+    editing boxdata in place.
+    """
+
+    # Convert the boxing information into a plain text string with no bounding information.
+    boxtext = ''.join([entry['char'] for entry in boxdata])
+    # Remove spacing and newlines from the readable text because the boxing data doesn't have those.
+    text = text.replace(' ', '')
+    text = text.replace('\n', '')
+
+    corrected = []
+    for action, a_start, a_end, b_start, b_end in match_text(boxtext, text):
+        boxes = boxdata[a_start:a_end]
+        chars = text[b_start:b_end]
+        if (action == 'equal'):
+            corrected.extend(boxes)
+        elif (action == 'replace'):
+            if (len(boxes) == 1) and (len(chars) == 1):
+                boxes[0]['char'] = chars
+                corrected.append(boxes[0])
+            elif (len(boxes) > 1) and (len(chars) == 1):
+                # Combine the boxing data
+                new = {'char':chars,
+                       'xmin':min([x['xmin'] for x in boxes]),
+                       'ymin':min([x['ymin'] for x in boxes]),
+                       'xmax':max([x['xmax'] for x in boxes]),
+                       'ymax':max([x['ymax'] for x in boxes])}
+                corrected.append(new)
+            elif (len(boxes) == len(chars)):
+                for box, char in zip(boxes, chars):
+                    box['char'] = char
+                corrected.extend(boxes)
+            else:
+                # Replace the boxdata with the plain text data, all using the same boxing
+                # data.  Will djvused complain that character boxes overlap?
+                for char in chars:
+                    corrected.append({'char':char, 'xmin':boxes[0]['xmin'], 'ymin':boxes[0]['ymin'], 'xmax':boxes[0]['xmax'], 'ymax':boxes[0]['ymax']})
+        elif (action == 'insert'):
+            # *Don't* use the boundaries of previous and next characters to guess at a boundary
+            # box.  Things would be ugly if the next character happened to be on a new line.
+            # Just duplicate the boundaries of the next character, or the previous one at the
+            # end of the page.
+            if a_start < len(boxdata):
+                target = boxdata[a_start]
+            elif len(corrected) > 0:
+                target = corrected[-1]
             else:
-                boxfilename = basename + '_box.box'
+                continue
+            for char in chars:
+                corrected.append({'char':char, 'xmin':target['xmin'], 'ymin':target['ymin'], 'xmax':target['xmax'], 'ymax':target['ymax']})
 
-            with open(boxfilename, 'r', encoding='utf8') as handle:
-                    boxfile = handle.read()
-            os.remove(boxfilename)
+    return corrected
 
-            utils.execute('{0} "{1}" "{2}_txt" {3} batch'.format(tesseractpath, filename, basename, self.options))
-            with open(basename+'_txt.txt', 'r', encoding='utf8') as handle:
-                text = handle.read()
-            os.remove(basename+'_txt.txt')
+def match_text(a, b, window=2000):
+    """
+    Returns the difflib opcodes that turn a into b.  Long texts are matched a window at
+    a time, so that the time taken grows linearly with the length of the page rather than
+    quadratically.  Each window ends after the last matching block found in it, and the
+    next one starts from there.  Texts that fit in a single window give the same result
+    as difflib.SequenceMatcher.
+    """
 
-            data = []
-            for line in boxfile.split('\n'):
-                if (line == ''):
-                    continue
-                line = line.split()
-                if len(line) != 5 and len(line) != 6: # Tesseract 3 box file has 6 columns
-                    print('err: ocr.boxfileParser.parse_box(): The format of the boxfile is not what was expected.', file=sys.stderr)
-                    sys.exit(1)
-                data.append({'char':line[0], 'xmin':int(line[1]), 'ymin':int(line[2]), 'xmax':int(line[3]), 'ymax':int(line[4])})
-            boxfile = data
-
-            boxfile = self._correct_boxfile(boxfile, text)
-            textfile = [text[x:x+1] for x in range(len(text))]
-            warning_count = 0
-
-            boxing = []
-            for x in range(len(textfile)):
-                char = textfile[x]
-                if (len(boxfile) == 0):
-                    break
-
-                if (char == '\n'):
-                    if (len(boxing) > 0) and (boxing[-1] != 'newline'):
-                        boxing.append('newline')
-                    continue
-                elif (char == ' '):
-                    if (len(boxing) > 0) and (boxing[-1] != 'space'):
-                        boxing.append('space')
-                    continue
-                else:
-                    if (char != boxfile[0]['char']):
-                        if (len(boxfile) >= 2) and (x+3 <= len(textfile)):
-                            # Maybe this character isn't certain (e/o/c) and we should skip to the next character in both files.
-                            if (textfile[x+1] == boxfile[1]['char']):
-                                boxfile.pop(0)
-                            # Maybe the boxfile inserted an extra character.
-                            elif (textfile[x] == boxfile[1]['char']):
-                                pass
-                            elif (warning_count == 0):
-                                warning_count = warning_count +1
-                                msg = 'wrn: tesseract produced a significant mismatch between textual data and character position data on "{0}".  This may result in partial ocr content for this page.'.format(os.path.split(filename)[1])
-                                msg = utils.color(msg, 'red')
-                                print(msg, file=sys.stderr)
-                        continue
-                    if (char in ['"', '\\']):
-                        boxfile.pop(0)
-                        continue
-                    boxing.append(boxfile.pop(0))
+    opcodes = []
+    a_pos = 0
+    b_pos = 0
+    while (a_pos < len(a)) or (b_pos < len(b)):
+        a_end = min(a_pos + window, len(a))
+        b_end = min(b_pos + window, len(b))
+        diff = difflib.SequenceMatcher(None, a[a_pos:a_end], b[b_pos:b_end])
+        chunk = [(action, a1 + a_pos, a2 + a_pos, b1 + b_pos, b2 + b_pos) for action, a1, a2, b1, b2 in diff.get_opcodes()]
+
+        if (a_end == len(a)) and (b_end == len(b)):
+            opcodes.extend(chunk)
+            break
+
+        # Stop after the last matching block, so that nothing past it is decided without
+        # seeing what follows the window.
+        last = None
+        for i in range(len(chunk)):
+            if chunk[i][0] == 'equal':
+                last = i
+        if last is None:
+            # Nothing in common at all; give up on this window as a whole.
+            if a_pos == a_end:
+                opcodes.append(('insert', a_pos, a_end, b_pos, b_end))
+            elif b_pos == b_end:
+                opcodes.append(('delete', a_pos, a_end, b_pos, b_end))
+            else:
+                opcodes.append(('replace', a_pos, a_end, b_pos, b_end))
+            a_pos = a_end
+            b_pos = b_end
+        else:
+            opcodes.extend(chunk[:last+1])
+            a_pos = chunk[last][2]
+            b_pos = chunk[last][4]
 
-            return boxing
+    return opcodes
+
+def merge_boxfile(boxdata, text, filename):
+    """
+    Walks through Tesseract's plain text alongside its (corrected) boxing data, and returns
+    a Boxing with the spaces and newlines of the text added.  filename is the image the
+    data came from, for warnings.
+    """
+
+    warning_count = 0
+    boxing = Boxing()
+    # Index of the next unused entry of boxdata.
+    pos = 0
+    for x in range(len(text)):
+        char = text[x]
+        if (pos == len(boxdata)):
+            break
+
+        if (char == '\n'):
+            if (len(boxing) > 0) and (boxing.last() != 'newline'):
+                boxing.add_break('newline')
+            continue
+        elif (char == ' '):
+            if (len(boxing) > 0) and (boxing.last() != 'space'):
+                boxing.add_break('space')
+            continue
+        else:
+            if (char != boxdata[pos]['char']):
+                if (len(boxdata) - pos >= 2) and (x+3 <= len(text)):
+                    # Maybe this character isn't certain (e/o/c) and we should skip to the next character in both files.
+                    if (text[x+1] == boxdata[pos+1]['char']):
+                        pos = pos + 1
+                    # Maybe the boxfile inserted an extra character.
+                    elif (text[x] == boxdata[pos+1]['char']):
+                        pass
+                    elif (warning_count == 0):
+                        warning_count = warning_count +1
+                        msg = 'wrn: tesseract produced a significant mismatch between textual data and character position data on "{0}".  This may result in partial ocr content for this page.'.format(os.path.split(filename)[1])
+                        msg = utils.color(msg, 'red')
+                        print(msg, file=sys.stderr)
+                continue
+            if (char in ['"', '\\']):
+                pos = pos + 1
+                continue
+            entry = boxdata[pos]
+            boxing.add_char(entry['char'], entry['xmin'], entry['ymin'], entry['xmax'], entry['ymax'])
+            pos = pos + 1
+
+    return boxing
+
+def parse_boxfile(boxfile):
+    """
+    Returns the entries of a Tesseract boxfile as a list of dictionaries (char, xmin, ymin,
+    xmax and ymax).
+    """
+
+    data = []
+    for line in boxfile.split('\n'):
+        if (line == ''):
+            continue
+        line = line.split()
+        if len(line) != 5 and len(line) != 6: # Tesseract 3 box file has 6 columns
+            print('err: ocr.boxfileParser.parse_box(): The format of the boxfile is not what was expected.', file=sys.stderr)
+            sys.exit(1)
+        data.append({'char':line[0], 'xmin':int(line[1]), 'ymin':int(line[2]), 'xmax':int(line[3]), 'ymax':int(line[4])})
 
+    return data
 
 def engine(ocr_engine, options=''):
     """
@@ -549,34 +832,83 @@ def engine(ocr_engine, options=''):
 
 def translate(boxing):
     """
-    Translate djvubind's internal boxing information into a djvused format.
+    Translate djvubind's internal boxing information (a Boxing, or a list in the older
+    form) into a djvused format.
+
+    The words are the runs of characters between breaks, and they follow each other
+    without gaps, so with numpy the bounding boxes of all words are found at once with
+    minimum.reduceat() and maximum.reduceat() over the coordinate arrays.  Without it,
+    min() and max() are taken over a slice of the arrays for each word.  The boxes of
+    lines and the page are then found from those of their words.
 
     .. warning::
        This function will eventually migrater to djvubind.encode
     """
 
-    page = djvuPageBox()
-    line = djvuLineBox()
-    word = djvuWordBox()
-    for entry in boxing:
-        if entry == 'newline':
-            if (word.children != []):
-                line.add_element(word)
-            page.add_element(line)
-            line = djvuLineBox()
-            word = djvuWordBox()
-        elif entry == 'space':
-            if (word.children != []):
-                line.add_element(word)
-            word = djvuWordBox()
-        else:
-            word.add_character(entry)
-    if (word.children != []):
-        line.add_element(word)
-    if (line.children != []):
-        page.add_element(line)
-
-    if (page.children != []):
-        return page.encode()
-    else:
+    if not isinstance(boxing, Boxing):
+        boxing = Boxing(boxing)
+
+    # Split the characters into words (start, end) and the words into lines.
+    lines = []
+    words = []
+    start = 0
+    count = len(boxing.ends)
+    for position, kind in zip(boxing.breaks, boxing.kinds):
+        if position > start:
+            words.append((start, position))
+        start = position
+        if kind == Boxing.NEWLINE:
+            lines.append(words)
+            words = []
+    if count > start:
+        words.append((start, count))
+    if (words != []):
+        lines.append(words)
+
+    if (lines == []):
         return ''
+
+    # The bounding box of each word, in order.  Empty words are left out, so each word
+    # ends where the next one starts, and the last one at the last character.
+    starts = [start for words in lines for start, end in words]
+    if (image.numpy is not None) and (starts != []):
+        numpy = image.numpy
+        starts = numpy.array(starts, dtype=numpy.intp)
+        columns = [numpy.minimum(numpy.minimum.reduceat(numpy.frombuffer(boxing.xmin, dtype=numpy.intc), starts), 1000000000),
+                   numpy.minimum(numpy.minimum.reduceat(numpy.frombuffer(boxing.ymin, dtype=numpy.intc), starts), 1000000000),
+                   numpy.maximum(numpy.maximum.reduceat(numpy.frombuffer(boxing.xmax, dtype=numpy.intc), starts), 0),
+                   numpy.maximum(numpy.maximum.reduceat(numpy.frombuffer(boxing.ymax, dtype=numpy.intc), starts), 0)]
+        boxes = list(zip(*[column.tolist() for column in columns]))
+    else:
+        boxes = [(min(1000000000, min(boxing.xmin[start:end])),
+                  min(1000000000, min(boxing.ymin[start:end])),
+                  max(0, max(boxing.xmax[start:end])),
+                  max(0, max(boxing.ymax[start:end]))) for words in lines for start, end in words]
+
+    # Boxes start out as impossible (min above max), until something is added to them.
+    text = boxing.chars.getvalue()
+    page = [1000000000, 1000000000, 0, 0]
+    encoded = []
+    index = 0
+    for words in lines:
+        line = [1000000000, 1000000000, 0, 0]
+        entries = []
+        for start, end in words:
+            word = boxes[index]
+            index = index + 1
+            if (word[0] > word[2]) or (word[1] > word[3]):
+                raise ValueError('Boxing information is impossible (x/y min exceed x/y max).')
+            entries.append('(word {0} {1} {2} {3} "{4}")'.format(word[0], word[1], word[2], word[3], boxing.text(start, end, text)))
+            line = [min(line[0], word[0]), min(line[1], word[1]), max(line[2], word[2]), max(line[3], word[3])]
+        page = [min(page[0], line[0]), min(page[1], line[1]), max(page[2], line[2]), max(page[3], line[3])]
+
+        # A line can happen to be blank (only cuneiform hocr?), and is left empty.
+        if entries == []:
+            encoded.append('')
+        else:
+            encoded.append('(line {0} {1} {2} {3}\n    {4})'.format(line[0], line[1], line[2], line[3], '\n    '.join(entries)))
+
+    if (page[0] > page[2]) or (page[1] > page[3]):
+        raise ValueError('Boxing information is impossible (x/y min exceed x/y max).')
+
+    return '(page {0} {1} {2} {3}\n  {4})'.format(page[0], page[1], page[2], page[3], '\n  '.join(encoded))
@@ -20,6 +20,8 @@ Data structures to organize collect and abstract information.
 import os
 import sys
 
+from . import cache
+from . import image
 from . import utils
 
 class Book:
@@ -64,9 +66,9 @@ class Book:
         """
 
         with open('book.csv', 'w', encoding='utf8') as handle:
-            handle.write('Path, Bitonal, DPI, Title, OCR\n')
+            handle.write('Path, Bitonal, Kind, DPI, Title, OCR\n')
             for page in self.pages:
-                entry = [page.path, str(page.bitonal), str(page.dpi), str(page.title), str(len(page.text))]
+                entry = [page.path, str(page.bitonal), str(page.kind), str(page.dpi), str(page.title), str(len(page.text))]
                 entry = ", ".join(entry)
                 handle.write(entry)
                 handle.write('\n')
@@ -83,6 +85,10 @@ class Page:
 
         self.bitonal = None
         self.dpi = 0
+        # 'bitonal', 'gray', 'lowcolor' or 'color'; see image.classify().
+        self.kind = None
+        self.hash = None
+        self.info = None
         self.text = ''
         self.title = None
 
@@ -91,24 +97,42 @@ class Page:
         Find the resolution of the image.
         """
 
-        dpi = utils.execute('identify -ping -format %x "{0}"'.format(self.path), capture=True).decode('ascii').split(' ')[0]
-        self.dpi = int(dpi)
+        self.get_info()
+        self.dpi = self.info['dpi']
+        return None
+
+    def get_hash(self):
+        """
+        Find the hash of the image contents, which identifies the page in caches.
+        """
+
+        if self.hash is None:
+            self.hash = cache.hash_file(self.path)
+        return self.hash
+
+    def get_info(self):
+        """
+        Find the properties of the image (depth, dpi, width, height, colorspace and
+        format), from the file header when possible.  This is only done once, and
+        everything else that needs to know about the image should use self.info.
+        """
+
+        if self.info is None:
+            self.info = image.get_info(self.path)
         return None
 
     def is_bitonal(self):
         """
-        Check if the image is bitonal.
+        Check if the image is bitonal, which includes images that are stored with more
+        than one bit per pixel but only use black and white.  This also finds the kind
+        of page (see image.classify()).
         """
 
-        if utils.execute('identify -ping "{0}"'.format(self.path), capture=True).decode('utf8').find('1-bit') == -1:
-            self.bitonal = False
-        else:
-            if int(utils.execute('identify -ping -format %z "{0}"'.format(self.path), capture=True).decode('utf8')) != 1:
-                print("msg: {0}: Bitonal image but with a depth greater than 1.  Modifying image depth.".format(os.path.split(self.path)[1]))
-                utils.execute('mogrify -colorspace gray -depth 1 "{0}"'.format(self.path))
-            self.bitonal = True
+        self.get_info()
+        self.kind = image.classify(self.path, self.info)
+        self.bitonal = (self.kind == 'bitonal')
 
-        if (self.path[-4:].lower() == '.pgm') and (self.bitonal is True):
+        if (self.path[-4:].lower() == '.pgm') and (self.info['depth'] == 1):
             msg = utils.color("wrn: {0}: Bitonal image but using a PGM format instead of PBM. Tesseract might get mad!".format(os.path.split(self.path)[1]), 'red')
             print(msg, file=sys.stderr)
         return None
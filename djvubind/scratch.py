@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Private scratch directories for intermediate files, so that pages (and books) can be
+worked on concurrently without their files getting in each other's way.
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from . import utils
+
+
+# Where scratch directories are made (None for the system's temporary directory) and
+# how many bytes must be left free there before a workspace is made.
+_root = None
+_reserve = 0
+
+# Every scratch directory that has not been removed yet, and the thread using each
+# workspace among them.
+_directories = set()
+_workspaces = {}
+_condition = threading.Condition()
+
+
+def configure(root='', reserve=0):
+    """
+    Set the directory that scratch directories are made in ('' for the system's
+    temporary directory, which can be changed with TMPDIR) and how many bytes must be
+    free there before a workspace is made (0 for no limit).
+    """
+
+    global _root, _reserve
+
+    if root == '':
+        _root = None
+    else:
+        _root = os.path.abspath(os.path.expanduser(root))
+        if not os.path.isdir(_root):
+            os.makedirs(_root)
+    _reserve = reserve
+
+    return None
+
+def root():
+    """
+    Returns the directory that scratch directories are made in.
+    """
+
+    if _root is None:
+        return tempfile.gettempdir()
+    return _root
+
+def make(prefix):
+    """
+    Make a scratch directory and return its path.  It is removed by remove(), or when
+    djvubind exits.
+    """
+
+    directory = tempfile.mkdtemp(prefix='djvubind-{0}-'.format(prefix), dir=_root)
+    with _condition:
+        _directories.add(directory)
+
+    return directory
+
+def remove(directory):
+    """
+    Remove a scratch directory made by make(), with everything in it.
+    """
+
+    shutil.rmtree(directory, ignore_errors=True)
+    with _condition:
+        _directories.discard(directory)
+        _workspaces.pop(directory, None)
+        _condition.notify_all()
+
+    return None
+
+def cleanup():
+    """
+    Remove every scratch directory that is still there.
+    """
+
+    with _condition:
+        directories = list(_directories)
+    for directory in directories:
+        remove(directory)
+
+    return None
+
+atexit.register(cleanup)
+
+
+class Workspace:
+    """
+    A scratch directory for the intermediate files of a single task (encoding or
+    recognizing a page, for example), removed along with them when the task is done:
+
+        with scratch.Workspace('cjb2') as work:
+            utils.run(['convert', infile, work.path('temp.pbm')])
+
+    When less than the configured reserve is free, a new workspace waits for those of
+    other threads to be removed.  If there are none, djvubind stops.
+    """
+
+    def __init__(self, prefix='task'):
+        self.prefix = prefix
+        self.directory = None
+
+    def __enter__(self):
+        me = threading.get_ident()
+        with _condition:
+            while (_reserve > 0) and (shutil.disk_usage(root()).free < _reserve):
+                if [thread for thread in _workspaces.values() if thread != me] == []:
+                    msg = 'err: scratch.Workspace(): less than {0} MiB free in "{1}".'.format(_reserve // 1048576, root())
+                    print(utils.color(msg, 'red'), file=sys.stderr)
+                    sys.exit(1)
+                _condition.wait(1)
+            self.directory = make(self.prefix)
+            _workspaces[self.directory] = me
+
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        remove(self.directory)
+        return False
+
+    def path(self, name):
+        """
+        Returns the path of a file in the workspace.
+        """
+
+        return os.path.join(self.directory, name)
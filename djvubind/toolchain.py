@@ -0,0 +1,223 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Finds the external programs djvubind uses, along with their versions and what they
+can do, once per run.  What was found can be kept on disk, so that later runs only
+have to check that the programs have not changed since.
+"""
+
+import json
+import os
+import re
+import threading
+
+from . import utils
+
+
+# Arguments that make a program print its version, for the programs whose version
+# changes how djvubind uses them.
+PROBES = {'tesseract':['--version']}
+
+# The file that what was found is kept in (None to keep it for this run only), what
+# was read from it for the current PATH, and every program looked up in this run.
+_file = None
+_stored = None
+_tools = {}
+_lock = threading.RLock()
+
+
+def configure(directory=''):
+    """
+    Keep what is found in a file in directory, or only for this run if directory is ''.
+    """
+
+    global _file, _stored
+
+    with _lock:
+        if directory == '':
+            _file = None
+        else:
+            _file = os.path.join(os.path.abspath(os.path.expanduser(directory)), 'toolchain.json')
+        _stored = None
+        _tools.clear()
+
+    return None
+
+def _stamp(path):
+    """
+    Returns what tells whether an executable was replaced: its size and modification time.
+    """
+
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+def _load(path):
+    """
+    Returns the programs kept on disk for the given PATH, as a dictionary of Tool.save()
+    output by program name.
+    """
+
+    global _stored
+
+    if (_stored is not None) and (_stored[0] == path):
+        return _stored[1]
+
+    tools = {}
+    if _file is not None:
+        try:
+            with open(_file, 'r', encoding='utf8') as handle:
+                data = json.load(handle)
+            if data['path'] == path:
+                tools = data['tools']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    _stored = (path, tools)
+
+    return tools
+
+def _save(path, tools):
+    """
+    Write the programs found for the given PATH to disk.  Failing to do so only means
+    that the next run has to look for them again.
+    """
+
+    if _file is None:
+        return None
+
+    temp = '{0}.{1}.tmp'.format(_file, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(_file)):
+            os.makedirs(os.path.dirname(_file))
+        with open(temp, 'w', encoding='utf8') as handle:
+            json.dump({'path':path, 'tools':tools}, handle, indent=1, sort_keys=True)
+        os.replace(temp, _file)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    return None
+
+def parse_version(output):
+    """
+    Returns the version number ('4.1.1', for example) from the output of a program's
+    --version option, which is the last word of the first line.
+    """
+
+    words = output.strip().split('\n')[0].split()
+    if words == []:
+        return None
+
+    return words[-1].lstrip('v')
+
+def major(version):
+    """
+    Returns the major number of a version, or 0 if it is not known.
+    """
+
+    number = re.match(r'\d*', version or '').group()
+    if number == '':
+        return 0
+
+    return int(number)
+
+def capabilities(name, version):
+    """
+    Returns what a version of a program can do, as a dictionary.
+    """
+
+    if name == 'tesseract':
+        # hocr output came with tesseract 3.  Since tesseract 4, a list of images can be
+        # given in place of an image, and the result is a single multipage hocr file.
+        return {'hocr':(major(version) >= 3), 'multifile':(major(version) >= 4)}
+
+    return {}
+
+
+class Tool:
+    """
+    An external program: where it is, its stamp (see _stamp()), its version if it
+    was asked for one (see PROBES), and what it can do.
+    """
+
+    def __init__(self, name, path, stamp, version=None, features=None):
+        self.name = name
+        self.path = path
+        self.stamp = stamp
+        self.version = version
+        if features is None:
+            features = capabilities(name, version)
+        self.features = features
+
+    def save(self):
+        """
+        Returns the tool as a dictionary that can be written to disk.
+        """
+
+        return {'path':self.path, 'stamp':self.stamp, 'version':self.version, 'features':self.features}
+
+
+def _discover(name, path):
+    """
+    Returns the Tool for a program, from disk if it has not changed, or None if it
+    cannot be found on the given PATH.
+    """
+
+    # PATH is searched every time, since a program installed in a directory that comes
+    # earlier on it takes the place of the one on disk.  Only the probe is saved.
+    executable = utils.get_executable_path(name)
+    if executable is None:
+        return None
+
+    tools = _load(path)
+    if name in tools:
+        entry = tools[name]
+        try:
+            if (entry['path'] == executable) and (_stamp(entry['path']) == entry['stamp']):
+                return Tool(name, entry['path'], entry['stamp'], entry['version'], entry['features'])
+        except (OSError, KeyError, TypeError):
+            pass
+
+    version = None
+    if name in PROBES:
+        # Some programs (older versions of tesseract, for one) print their version on
+        # stderr, and others on stdout.
+        output = utils.run([executable] + PROBES[name], capture=True, check=False, stderr=True)
+        version = parse_version(output.decode('utf8', 'replace'))
+    tool = Tool(name, executable, _stamp(executable), version)
+
+    tools[name] = tool.save()
+    _save(path, tools)
+
+    return tool
+
+def find(name):
+    """
+    Returns the Tool for a program, or None if it is not installed.  A program is only
+    looked for once per run (and PATH).
+    """
+
+    path = os.environ.get('PATH', '')
+    with _lock:
+        if (path, name) not in _tools:
+            _tools[(path, name)] = _discover(name, path)
+        return _tools[(path, name)]
+
+def is_installed(name):
+    """
+    Checks if a program is available.  Handy for dependency checks on external commands.
+    """
+
+    return find(name) is not None
@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc.
+"""
+Records how long each stage of each page takes, in the Chrome trace event format
+(which can be opened with chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import json
+import os
+import threading
+import time
+
+
+# The tracer of the current run, or None if tracing is off.
+_tracer = None
+
+# The page each thread is currently working on, which is added to every span the
+# thread records.
+_local = threading.local()
+
+
+class Tracer:
+    """
+    Collects complete ("X") events.  Times are taken from time.time(), so that the
+    worker processes that parse ocr output can report spans on the same clock.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, end, args=None, pid=None, tid=None):
+        """
+        Record a span from start to end (in seconds, from time.time()).
+        """
+
+        if pid is None:
+            pid = self.pid
+        if tid is None:
+            tid = threading.get_ident()
+        event = {'name':name, 'cat':category, 'ph':'X', 'pid':pid, 'tid':tid,
+                 'ts':int((start - self.start) * 1000000),
+                 'dur':max(0, int((end - start) * 1000000)),
+                 'args':args or {}}
+        with self.lock:
+            self.events.append(event)
+            if (pid, tid) not in self.threads:
+                if pid == self.pid:
+                    self.threads[(pid, tid)] = threading.current_thread().name
+                else:
+                    self.threads[(pid, tid)] = 'worker {0}'.format(pid)
+
+        return None
+
+    def save(self, filename):
+        """
+        Write the trace to filename as JSON.
+        """
+
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+
+        # Metadata events name the rows of the trace viewer.
+        for pid in set([pid for pid, tid in threads]):
+            if pid == self.pid:
+                name = 'djvubind'
+            else:
+                name = 'ocr worker'
+            events.append({'name':'process_name', 'ph':'M', 'pid':pid, 'tid':0, 'args':{'name':name}})
+        for (pid, tid), name in threads.items():
+            events.append({'name':'thread_name', 'ph':'M', 'pid':pid, 'tid':tid, 'args':{'name':name}})
+
+        with open(filename, 'w', encoding='utf8') as handle:
+            json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, handle)
+
+        return None
+
+
+class span:
+    """
+    Context manager that records its body as a span, along with the cpu time used by
+    the thread.  Spans recorded inside it (commands run, for example) are labelled with
+    its page.  Does nothing when tracing is off.
+    """
+
+    def __init__(self, name, category='stage', page=None, **args):
+        self.name = name
+        self.category = category
+        self.page = page
+        self.args = args
+
+    def __enter__(self):
+        if _tracer is None:
+            return self
+        self.previous = getattr(_local, 'page', None)
+        if self.page is not None:
+            _local.page = self.page
+        self.start = time.time()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if _tracer is None:
+            return False
+        args = dict(self.args)
+        args['cpu'] = round(time.thread_time() - self.cpu, 6)
+        if kind is not None:
+            args['error'] = kind.__name__
+        complete(self.name, self.category, self.start, time.time(), args)
+        _local.page = self.previous
+        return False
+
+
+def start():
+    """
+    Start recording spans.
+    """
+
+    global _tracer
+    _tracer = Tracer()
+
+    return None
+
+def stop():
+    """
+    Stop recording spans, discarding the ones recorded so far.
+    """
+
+    global _tracer
+    _tracer = None
+
+    return None
+
+def enabled():
+    """
+    Returns whether spans are being recorded.
+    """
+
+    return _tracer is not None
+
+def complete(name, category, start, end, args=None, pid=None, tid=None):
+    """
+    Record a span that has already finished.  It is labelled with the page of the
+    enclosing span(), if there is one.
+    """
+
+    if _tracer is None:
+        return None
+    args = dict(args or {})
+    page = getattr(_local, 'page', None)
+    if (page is not None) and ('page' not in args):
+        args['page'] = page
+    args['worker'] = threading.current_thread().name
+    _tracer.add(name, category, start, end, args, pid, tid)
+
+    return None
+
+def save(filename):
+    """
+    Write the spans recorded so far to filename, if tracing is on.
+    """
+
+    if _tracer is not None:
+        _tracer.save(filename)
+
+    return None
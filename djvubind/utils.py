@@ -20,8 +20,18 @@ Common and simple functions that are used throughout everything else.
 
 import multiprocessing
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import trace
 
 roman_numeral_map = (('m',  1000), ('cm', 900), ('d',  500),
                      ('cd', 400), ('c',  100), ('xc', 90),
@@ -29,6 +39,15 @@ roman_numeral_map = (('m',  1000), ('cm', 900), ('d',  500),
                      ('ix', 9), ('v',  5), ('iv', 4), ('i',  1))
 html_codes = (['&', '&amp;'],['<', '&lt;'],['>', '&gt;'],['"', '&quot;'])
 
+# State shared by the threads that call run(): the programs that are still running
+# (each mapped to the reason it was killed, if it was), what every program has cost so
+# far, and the default time limit.
+_lock = threading.Lock()
+_running = {}
+_stats = {}
+_cancelled = threading.Event()
+_timeout = None
+
 def arabic_to_roman(number):
     """
     convert arabic integer to roman numeral
@@ -94,113 +113,325 @@ def replace_html_codes(text):
 
     return text
 
-def split_cmd(start, files, end=''):
+def command_limit():
     """
+    Returns how long a command may be, counting each argument as in split_cmd().
+
     Rumor has it that Windows has a character limit of a little more than 32,000 for commands.[1]
-    Linux seems to vary based on kernel settings and whatnot, but tends to be more in the millions.[2]
-    Supposing the images are named 'page_0001.tif', we can hit the windows limit very quickly.  For the
-    sake of being safe, we will split things up at the 32,000 mark.
+    Elsewhere the limit is ARG_MAX, which is shared with the environment and tends to be
+    in the millions on Linux.[2]  Some of it is held back, in case the environment of the
+    program grows.
 
     [1] http://stackoverflow.com/questions/2381241/what-is-the-subprocess-popen-max-length-of-the-args-parameter
     [2] http://www.linuxjournal.com/article/6060
     """
-    #print(cmd)
 
-    cmds = []
-    start = start + ' '
-    end = ' ' + end
+    if sys.platform.startswith('win'):
+        return 32000
+    try:
+        limit = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        limit = -1
+    if limit <= 0:
+        return 32000
+    environment = sum([len(key) + len(value) + 2 + 8 for key, value in os.environ.items()])
 
-    buffer = start
-    while len(files) > 0:
-        if len(buffer) + len(files[0]) + len(end) + 3 < 32000:
-            buffer = buffer + ' "' + files.pop(0) + '"'
-        else:
-            buffer = buffer + end.rstrip()
-            cmds.append(buffer)
-            buffer = start
-    buffer = buffer + end.rstrip()
-    cmds.append(buffer)
+    return max(32000, limit - environment - 65536)
+
+def split_cmd(start, files, end=None, limit=None):
+    """
+    Split a command with a long list of files into as few commands as possible that are
+    each within limit characters (by default, command_limit()).  Each argument counts
+    for its length, plus a separating space and a pair of quotes on Windows, or the
+    terminating NUL and the pointer to it elsewhere.
+
+    start and end are the arguments that go before and after the files in each command.
+    Returns a list of argument lists, for run().
+    """
+
+    if end is None:
+        end = []
+    if limit is None:
+        limit = command_limit()
+    if sys.platform.startswith('win'):
+        overhead = 3
+    else:
+        overhead = 9
+    fixed = sum([len(arg) + overhead for arg in start + end])
+
+    cmds = []
+    group = []
+    length = fixed
+    for filename in files:
+        if (length + len(filename) + overhead >= limit) and (len(group) > 0):
+            cmds.append(start + group + end)
+            group = []
+            length = fixed
+        group.append(filename)
+        length = length + len(filename) + overhead
+    cmds.append(start + group + end)
 
     return cmds
 
-def separate_cmd(cmd):
-    """
-    Convert a subprocess command string into a list, intelligently handling arguments
-    enclosed in single or double quotes.
-    """
-    #print(cmd)
-
-    cmd = list(cmd)
-    buffer = ''
-    out = []
-    switch = [False, '']
-
-    for x in range(len(cmd)):
-        char = cmd[x]
-        if char == ' ' and not switch[0]:
-            out.append(buffer)
-            buffer = ''
-        # Be wary of a single/double quote that is part of a filename and not part of an
-        # enclosing pair
-        elif (char == '"' or char == "'") and not switch[0]:
-            if (char in cmd[x+1:]) and (buffer == ''):
-                switch[0] = True
-                switch[1] = char
-            else:
-                buffer = buffer + char
-        elif char == switch[1] and switch[0]:
-            out.append(buffer)
-            buffer = ''
-            switch[0] = False
-        else:
-            buffer = buffer + char
-    out.append(buffer)
+def set_timeout(seconds):
+    """
+    Set how long, in seconds, a program started by run() may take before it is killed.
+    None (or 0) means no limit.
+    """
 
-    # Just in case there were multiple spaces.
-    while '' in out:
-        out.remove('')
+    global _timeout
+    _timeout = seconds or None
 
-    return out
+    return None
 
-def simple_exec(cmd):
+def cancel():
     """
-    Execute a simple command.  Any output disregarded and exit status is
-    returned.
+    Kill every program started by run() that is still going, and refuse to start any
+    more.  Used to stop the threads of a run that is being abandoned.
     """
-    #print(cmd)
 
-    cmd = separate_cmd(cmd)
-    with open(os.devnull, 'w') as void:
-        sub = subprocess.Popen(cmd, shell=False, stdout=void, stderr=void)
-        status = int(sub.wait())
+    _cancelled.set()
+    with _lock:
+        for sub in list(_running):
+            _kill(sub, 'cancelled')
 
-    return status
+    return None
 
-def execute(cmd, capture=False):
+def _kill(sub, reason):
     """
-    Execute a command line process.  Includes the option of capturing output,
-    and checks for successful execution.
+    Kill a program started by run(), unless it has already exited.  The caller holds
+    _lock, so the process cannot be reaped (and its pid reused) in the meantime.
     """
-    #print(cmd)
 
-    with open(os.devnull, 'w') as void:
-        if capture:
-            sub = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=void)
+    if (sub in _running) and (_running[sub] is None):
+        _running[sub] = reason
+        if os.name == 'posix':
+            # Popen.kill() would poll the process, which could reap it behind _wait()'s back.
+            os.kill(sub.pid, signal.SIGKILL)
         else:
-            sub = subprocess.Popen(cmd, shell=True, stdout=void, stderr=void)
-    status = sub.wait()
+            sub.kill()
+
+    return None
+
+def _timed_out(sub):
+    with _lock:
+        _kill(sub, 'timeout')
+
+    return None
+
+def _feed(pipe, data):
+    """
+    Write data to a program's standard input and close it.  A program that exits
+    without reading all of it is left to report its own error.
+    """
+
+    try:
+        pipe.write(data)
+        pipe.close()
+    except OSError:
+        pass
 
-    # Exit if the command fails for any reason.
-    if status != 0:
-        print(color("err: [utils.execute()] Command exited with bad status.", 'red'), file=sys.stderr)
-        print('     cmd = {0}\n     exit status = {1}'.format(cmd, status), file=sys.stderr)
+    return None
+
+def _wait(sub):
+    """
+    Wait for a program started by run() to exit.  Returns its exit status, its resource
+    usage (None where wait4() is not available) and the reason it was killed, if it was.
+    """
+
+    if hasattr(os, 'wait4') and hasattr(os, 'waitid'):
+        # Wait for the exit without reaping the process, so that _kill() can never signal
+        # a pid that has been reused, and then reap it along with its resource usage.
+        os.waitid(os.P_PID, sub.pid, os.WEXITED | os.WNOWAIT)
+        with _lock:
+            reason = _running.pop(sub)
+        pid, status, usage = os.wait4(sub.pid, 0)
+        sub.returncode = os.waitstatus_to_exitcode(status)
+    else:
+        sub.wait()
+        usage = None
+        with _lock:
+            reason = _running.pop(sub)
+
+    return sub.returncode, usage, reason
+
+def _peak(usage):
+    """
+    Returns the largest resident set size (in kilobytes) of a program that has exited,
+    given its resource usage, or None if it is not known.
+
+    A program starts out as a copy of djvubind, and the peak that wait4() reports is
+    carried over when it executes, so what is reported is really the larger of the
+    program's own peak and djvubind's peak when it was started.  That can only be told
+    apart from djvubind's when it is higher than djvubind's peak now.
+    """
+
+    if (usage is None) or (resource is None):
+        return None
+    rss = usage.ru_maxrss
+    if rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    # ru_maxrss is in kilobytes, except on Mac OS X where it is in bytes.
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+
+    return rss
+
+def _account(program, wall, usage, peak):
+    """
+    Add the cost of one run of a program to the statistics reported by command_stats().
+    """
+
+    name = os.path.basename(program)
+    with _lock:
+        entry = _stats.setdefault(name, {'calls':0, 'wall':0.0, 'user':0.0, 'system':0.0, 'maxrss':None})
+        entry['calls'] = entry['calls'] + 1
+        entry['wall'] = entry['wall'] + wall
+        if usage is not None:
+            entry['user'] = entry['user'] + usage.ru_utime
+            entry['system'] = entry['system'] + usage.ru_stime
+        if peak is not None:
+            entry['maxrss'] = max(entry['maxrss'] or 0, peak)
+
+    return None
+
+def command_stats():
+    """
+    Returns what the programs started by run() have cost so far, as a dictionary that
+    maps each program's name to its number of calls, total wall, user and system time
+    in seconds, and largest resident set size in kilobytes.  The latter is None if no
+    call used more memory than djvubind itself (see _peak()).
+    """
+
+    with _lock:
+        stats = {}
+        for name in _stats:
+            stats[name] = dict(_stats[name])
+
+    return stats
+
+def run(args, capture=False, check=True, timeout=None, stderr=False, input=None, threads=None):
+    """
+    Run a program, given as a list of arguments.  No shell is involved, so arguments
+    need no quoting.  The wall time, cpu time and memory used by the program are added
+    to command_stats().
+
+    If capture is True, the program's output (bytes) is returned, and also includes
+    its error output if stderr is True.  Otherwise the exit status is returned.  If
+    input (bytes) is given, it is written to the program's standard input.  The
+    program is killed if it takes longer than timeout seconds (by default, the limit set
+    with set_timeout()).  If check is True, a program that fails, times out or is
+    cancelled ends djvubind, like any other fatal error.
+
+    If threads is given, the program is told to use at most that many threads for
+    itself.  This covers OpenMP programs such as tesseract and ImageMagick's own thread
+    pool, and only applies to this one program.
+    """
+
+    args = [str(arg) for arg in args]
+    if timeout is None:
+        timeout = _timeout
+
+    if capture:
+        stdout = subprocess.PIPE
+    else:
+        stdout = subprocess.DEVNULL
+    if capture and stderr:
+        errout = subprocess.STDOUT
+    else:
+        errout = subprocess.DEVNULL
+    if input is None:
+        stdin = None
+    else:
+        stdin = subprocess.PIPE
+    env = None
+    if threads is not None:
+        env = dict(os.environ)
+        env['OMP_THREAD_LIMIT'] = str(threads)
+        env['MAGICK_THREAD_LIMIT'] = str(threads)
+
+    output = b''
+    usage = None
+    reason = None
+    start = time.time()
+    if _cancelled.is_set():
+        status = None
+        reason = 'cancelled'
+    else:
+        try:
+            sub = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=errout, env=env)
+        except OSError:
+            # The same status a shell gives for a program that cannot be found.
+            status = 127
+        else:
+            with _lock:
+                _running[sub] = None
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, _timed_out, [sub])
+                timer.daemon = True
+                timer.start()
+            # Input is written from another thread, so that a program which writes
+            # output before reading all of its input cannot block on a full pipe.
+            writer = None
+            if input is not None:
+                writer = threading.Thread(target=_feed, args=(sub.stdin, input))
+                writer.daemon = True
+                writer.start()
+            try:
+                if capture:
+                    output = sub.stdout.read()
+                    sub.stdout.close()
+            finally:
+                status, usage, reason = _wait(sub)
+                if timer is not None:
+                    timer.cancel()
+                if writer is not None:
+                    writer.join()
+            peak = _peak(usage)
+            _account(args[0], time.time() - start, usage, peak)
+            details = {'cmd':subprocess.list2cmdline(args), 'status':status}
+            if usage is not None:
+                details.update({'user':usage.ru_utime, 'system':usage.ru_stime})
+            if peak is not None:
+                details['maxrss'] = peak
+            trace.complete(os.path.basename(args[0]), 'command', start, time.time(), details)
+
+    if check and ((status != 0) or (reason is not None)):
+        if reason == 'cancelled':
+            sys.exit(1)
+        elif reason == 'timeout':
+            print(color("err: [utils.run()] Command timed out after {0} seconds.".format(timeout), 'red'), file=sys.stderr)
+        else:
+            print(color("err: [utils.run()] Command exited with bad status.", 'red'), file=sys.stderr)
+        print('     cmd = {0}\n     exit status = {1}'.format(subprocess.list2cmdline(args), status), file=sys.stderr)
         sys.exit(1)
 
     if capture:
-        text = sub.stdout.read()
-        return text
+        return output
     else:
-        return None
+        return status
+
+def identify(path):
+    """
+    Returns a dictionary of image properties (depth, dpi, width, height, colorspace and
+    format), all found with a single call to ImageMagick's identify.
+    """
+
+    cmd = ['identify', '-ping', '-format', '%z|%x|%w|%h|%[colorspace]|%m\\n', path]
+    text = run(cmd, capture=True).decode('utf8')
+
+    # Multipage images give one line per frame; only the first one matters.
+    fields = text.split('\n')[0].split('|')
+    info = {'depth':int(fields[0]),
+            # Older versions of ImageMagick include the units (e.g. "300 PixelsPerInch").
+            'dpi':int(round(float(fields[1].split()[0]))),
+            'width':int(fields[2]),
+            'height':int(fields[3]),
+            'colorspace':fields[4],
+            'format':fields[5]}
+
+    return info
 
 def list_files(directory='.', contains=None, extension=None):
     """Find all files in a given directory that match criteria."""
@@ -234,6 +465,7 @@ def list_files(directory='.', contains=None, extension=None):
 def is_executable(command):
     """
     Checks if a given command is available.  Handy for dependency checks on external commands.
+    This looks through PATH on every call; toolchain.is_installed() only does so once.
     """
 
     if get_executable_path(command) is not None:
@@ -245,6 +477,7 @@ def is_executable(command):
 def get_executable_path(command):
     """
     Checks if a given command is available and returns the path to the executable (if available).
+    This looks through PATH on every call; toolchain.find() only does so once.
     """
 
     # Add extension if on the windows platform.
@@ -302,3 +535,42 @@ def cpu_count():
         cpus = 1
 
     return cpus
+
+def split_threads(cores, pagecount, parallel=0.0):
+    """
+    Splits a budget of cores between worker threads, which each handle one page at a
+    time, and the threads that the program run for each page may start itself.
+    'parallel' is the fraction of that program's work that can use more than one thread
+    (0 for programs that only ever use one).  Returns (workers, threads).
+    """
+
+    cores = max(1, cores)
+    pagecount = max(1, pagecount)
+    parallel = min(1.0, max(0.0, parallel))
+
+    # Estimate the time to finish the book, in units of single threaded pages, with
+    # each possible number of workers.  The spare cores go to each program, and are
+    # assumed to speed it up as Amdahl's law predicts.  Ties go to more workers, since
+    # running pages side by side is always at least as efficient.
+    best = None
+    for workers in range(min(cores, pagecount), 0, -1):
+        threads = cores // workers
+        rounds = (pagecount + workers - 1) // workers
+        cost = rounds * ((1 - parallel) + (parallel / threads))
+        if (best is None) or (cost < best[0] - 1e-9):
+            best = (cost, workers, threads)
+
+    return best[1], best[2]
+
+def parallel_fraction(single, multi, threads):
+    """
+    Returns the fraction of a program's work that runs in parallel, given the time it
+    took with one thread and with the given number of threads.
+    """
+
+    if (single <= 0) or (multi <= 0) or (threads < 2):
+        return 0.0
+    speedup = single / multi
+    parallel = (1 - (1 / speedup)) / (1 - (1 / threads))
+
+    return min(1.0, max(0.0, parallel))
@@ -9,7 +9,7 @@ setup (name='djvubind',
       author_email='strider1551@gmail.com',
       url='https://code.google.com/p/djvubind/',
       license='GPL-3',
-      py_modules=['djvubind/__init__', 'djvubind/encode', 'djvubind/ocr', 'djvubind/organizer', 'djvubind/utils'],
+      py_modules=['djvubind/__init__', 'djvubind/cache', 'djvubind/djvm', 'djvubind/encode', 'djvubind/image', 'djvubind/journal', 'djvubind/ocr', 'djvubind/organizer', 'djvubind/scratch', 'djvubind/toolchain', 'djvubind/trace', 'djvubind/utils'],
       data_files=[('bin', ['bin/djvubind']),
                   ('/etc/djvubind', ['docs/config']),
                   ('share/man/man1', ['docs/djvubind.1.gz'])]